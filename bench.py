@@ -0,0 +1,101 @@
+## Micro-benchmarks for the hot paths, runnable without a database or SMTP server
+
+import argparse
+import gc
+import time
+import tracemalloc
+
+import composer
+import feeds
+import rss_manager
+import sanitiser
+
+def _synthetic_feed(items: int, summary_chars: int, feed: int = 0) -> bytes:
+    body = ("<p>Lorem ipsum dolor sit amet, <a href=\"/more\">consectetur</a> adipiscing elit.</p>" * (summary_chars // 80 + 1))[:summary_chars]
+    parts = [
+        '<?xml version="1.0"?><rss version="2.0" xmlns:content="http://purl.org/rss/1.0/modules/content/">'
+        '<channel><title>Bench</title><link>https://example.com/</link>'
+    ]
+    for i in range(items):
+        parts.append(
+            f"<item><title>Item {i}</title><link>https://example.com/{feed}/posts/{i}</link>"
+            f"<guid>https://example.com/{feed}/posts/{i}</guid>"
+            f"<pubDate>Mon, 06 Sep 2021 16:45:00 +0000</pubDate>"
+            f"<description><![CDATA[<img src=\"/img/{i}.png\"/>{body}]]></description>"
+            f"<content:encoded><![CDATA[{body * 4}]]></content:encoded></item>"
+        )
+    parts.append("</channel></rss>")
+    return "".join(parts).encode("utf-8")
+
+def bench_entry_memory(feed_count: int = 3, items: int = 60, summary_chars: int = 2000) -> None:
+    # A whole run without the network or DB: parse every feed and keep the results alive, as
+    # fetching does, then turn the entries into articles and compose the digest from them.
+    # "parsed" is what the entries hold once parsing is done; "peak" covers the whole run.
+    contents = [_synthetic_feed(items, summary_chars, f) for f in range(feed_count)]
+    print(f"run memory: {feed_count} feeds x {items} items, {len(contents[0]) / 1024:.0f} KiB per feed")
+    for label, keep_raw in (("raw kept", True), ("compact", False)):
+        with composer._prepared_lock:
+            composer._prepared_cache.clear()
+        gc.collect()
+        tracemalloc.start()
+        started = time.perf_counter()
+        results = [feeds.parse_entries(content, keep_raw=keep_raw) for content in contents]
+        parsed = tracemalloc.get_traced_memory()[0]
+        articles = []
+        for f, result in enumerate(results):
+            articles += rss_manager._ingest_entries({"id": f, "url": f"https://example.com/{f}/feed"}, result["entries"], persist=False)
+        composer.compose_digest(articles)
+        elapsed = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"  {label:<9} parsed {parsed / 2**20:8.1f} MiB   run peak {peak / 2**20:8.1f} MiB   {elapsed:.2f}s")
+        del results, articles
+
+def _regex_chain(summary: str, base: str):
+    # What composer._prepare_item did before sanitiser.process_summary
+    absolute = composer._make_urls_absolute(summary, base)
+    thumbnail = composer._extract_first_image(absolute, base)
+    stripped = composer._strip_first_image_from_html(absolute)
+    return stripped, thumbnail, composer._strip_tags(stripped)
+
+def _time(fn, *args, repeat: int = 3) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        sanitiser._join.cache_clear()
+        started = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+def bench_summary(sizes=(10_000, 100_000, 1_000_000), pathological_sizes=(1_000, 2_000, 4_000)) -> None:
+    base = "https://example.com"
+    typical = '<p><img src="/img/{i}.png"/>An <a href="/posts/{i}">article</a> with &amp; entities.</p>'
+    # Unterminated <script> openers make the old non-greedy regex rescan to the end from each one;
+    # the sizes are kept small because the regex chain is quadratic here
+    pathological = "<script>x" + "<p>a</p>"
+    print("summary rewriting: regex chain vs single pass (best of 3)")
+    for label, unit, label_sizes in (("typical", typical, sizes), ("pathological", pathological, pathological_sizes)):
+        for size in label_sizes:
+            summary = "".join(unit.format(i=i) for i in range(size // len(unit) + 1))[:size]
+            old = _time(_regex_chain, summary, base)
+            new = _time(sanitiser.process_summary, summary, base)
+            print(f"  {label:<12} {size / 1000:>6.0f} KB   regex {old * 1000:9.1f} ms   single pass {new * 1000:9.1f} ms")
+
+BENCHMARKS = {
+    "entry-memory": bench_entry_memory,
+    "summary": bench_summary,
+}
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="rss-digest micro-benchmarks")
+    parser.add_argument("names", nargs="*", help=f"benchmarks to run: {', '.join(BENCHMARKS)} (default: all)")
+    args = parser.parse_args()
+    unknown = [n for n in args.names if n not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmark(s): {', '.join(unknown)}")
+    for name in args.names or BENCHMARKS:
+        BENCHMARKS[name]()
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
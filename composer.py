@@ -1,12 +1,104 @@
-from typing import List, Dict, Optional, Tuple
+from collections import OrderedDict
+from typing import List, Dict, Iterable, Iterator, Optional, Tuple
 from datetime import datetime, UTC
-from jinja2 import Template
+from jinja2 import Environment, ChoiceLoader, DictLoader, FileSystemLoader, FileSystemBytecodeCache, Template
+from pathlib import Path
 import re
 import html
 from urllib.parse import urlparse, urljoin
+import hashlib
+import logging
+import threading
 import config
+import db
+import sanitiser
 
-HTML_TEMPLATE = """
+logger = logging.getLogger(__name__)
+
+# Bump whenever derive_fields() output changes so stale cached items are ignored
+COMPOSER_VERSION = 1
+PREPARED_FIELDS = ("summary", "summary_text", "short_summary", "thumbnail", "feed_icon")
+PREPARED_CACHE_SIZE = 4096
+DEFAULT_SUMMARY_CHARS = 600
+
+_prepared_cache: "OrderedDict[str, Dict]" = OrderedDict()
+_prepared_lock = threading.Lock()
+
+HTML_TEMPLATE = """{#- Item and TOC rows are macros so a digest draft can render them one at a time -#}
+{% macro item_row(it) %}
+        <tr>
+          <td style="padding-top:12px;">
+            <table width="100%" cellpadding="0" cellspacing="0" border="0" role="presentation" style="background:#ffffff;border-radius:10px;border:1px solid #e9eef5;">
+              <tr>
+                <td style="padding:12px;">
+                  <table width="100%" cellpadding="0" cellspacing="0" border="0" role="presentation">
+                    <tr class="two-col">
+                      <!-- Content -->
+                      <td class="col" valign="top" style="padding-right:12px;vertical-align:top;">
+                        <table cellpadding="0" cellspacing="0" border="0" role="presentation" width="100%">
+                          <tr><td style="padding-bottom:6px;">
+                            <table cellpadding="0" cellspacing="0" border="0" role="presentation">
+                              <tr>
+                                <td style="vertical-align:middle;padding-right:8px;">
+                                  <img src="{{ it.feed_icon }}" width="28" height="28" alt="" style="display:block;border-radius:6px;border:1px solid #eef3fa;" />
+                                </td>
+                                <td style="vertical-align:middle;font-size:13px;color:#6b7280;">
+                                  <strong style="font-weight:700;color:#0b2a66;">{{ it.feed_title or it.feed_url }}</strong>
+                                </td>
+                              </tr>
+                            </table>
+                          </td></tr>
+
+                          <tr><td style="padding-bottom:8px;"><a href="{{ it.link }}" style="color:#071033;text-decoration:none;font-size:16px;font-weight:700;">{{ it.title }}</a></td></tr>
+
+                          <tr><td style="padding-bottom:8px;color:#6b7280;font-size:13px;">{% if it.category %}{{ it.category }} · {% endif %}{% if it.published %}{{ it.published|datetimeformat }}{% endif %}</td></tr>
+
+                          <tr><td style="padding-bottom:10px;color:#333a52;font-size:14px;line-height:1.45;">{{ it.summary | safe }}</td></tr>
+
+                          <tr>
+                            <td>
+                              <!-- Primary button only -->
+                              <table cellpadding="0" cellspacing="0" border="0" role="presentation">
+                                <tr>
+                                  <td>
+                                    <a href="{{ it.link }}" style="background-color:#0f62fe;border-radius:6px;color:#ffffff;display:inline-block;padding:10px 14px;text-decoration:none;font-weight:600;font-size:13px;">
+                                      Read article →
+                                    </a>
+                                  </td>
+                                </tr>
+                              </table>
+                            </td>
+                          </tr>
+
+                        </table>
+                      </td>
+
+                      <!-- Thumbnail -->
+                      <td class="col" valign="top" style="width:180px;">
+                        {% if it.thumbnail %}
+                          <a href="{{ it.link }}"><img alt="" class="thumbnail" src="{{ it.thumbnail }}" width="170" height="110" style="display:block;border-radius:8px;border:1px solid #eef3fa;object-fit:cover;max-width:100%;height:auto;" /></a>
+                        {% else %}
+                          <div style="width:170px;height:110px;border-radius:8px;border:1px solid #eef3fa;background:#fbfdff;color:#6b7280;display:flex;align-items:center;justify-content:center;font-size:13px;">
+                            {{ it.feed_title or '' }}
+                          </div>
+                        {% endif %}
+                      </td>
+
+                    </tr>
+                  </table>
+                </td>
+              </tr>
+            </table>
+          </td>
+        </tr>
+        {% endmacro %}{% macro toc_row(it, index) %}
+              <tr>
+                <td style="padding:8px 0;border-top:1px solid #f1f5f9;">
+                  <a href="#item-{{ index - 1 }}" style="color:#0f62fe;text-decoration:none;font-size:14px;">{{ index }}. {{ it.title }}</a>
+                  <div style="color:#8292a6;font-size:12px;margin-top:4px;">{{ it.feed_title or it.feed_url }}</div>
+                </td>
+              </tr>
+              {% endmacro %}
 <!doctype html>
 <html>
 <head>
@@ -93,73 +185,7 @@ HTML_TEMPLATE = """
         </tr>
 
         <!-- Items -->
-        {% for it in items %}
-        <tr>
-          <td style="padding-top:12px;">
-            <table width="100%" cellpadding="0" cellspacing="0" border="0" role="presentation" style="background:#ffffff;border-radius:10px;border:1px solid #e9eef5;">
-              <tr>
-                <td style="padding:12px;">
-                  <table width="100%" cellpadding="0" cellspacing="0" border="0" role="presentation">
-                    <tr class="two-col">
-                      <!-- Content -->
-                      <td class="col" valign="top" style="padding-right:12px;vertical-align:top;">
-                        <table cellpadding="0" cellspacing="0" border="0" role="presentation" width="100%">
-                          <tr><td style="padding-bottom:6px;">
-                            <table cellpadding="0" cellspacing="0" border="0" role="presentation">
-                              <tr>
-                                <td style="vertical-align:middle;padding-right:8px;">
-                                  <img src="{{ it.feed_icon }}" width="28" height="28" alt="" style="display:block;border-radius:6px;border:1px solid #eef3fa;" />
-                                </td>
-                                <td style="vertical-align:middle;font-size:13px;color:#6b7280;">
-                                  <strong style="font-weight:700;color:#0b2a66;">{{ it.feed_title or it.feed_url }}</strong>
-                                </td>
-                              </tr>
-                            </table>
-                          </td></tr>
-
-                          <tr><td style="padding-bottom:8px;"><a href="{{ it.link }}" style="color:#071033;text-decoration:none;font-size:16px;font-weight:700;">{{ it.title }}</a></td></tr>
-
-                          <tr><td style="padding-bottom:8px;color:#6b7280;font-size:13px;">{% if it.category %}{{ it.category }} · {% endif %}{% if it.published %}{{ it.published|datetimeformat }}{% endif %}</td></tr>
-
-                          <tr><td style="padding-bottom:10px;color:#333a52;font-size:14px;line-height:1.45;">{{ it.summary | safe }}</td></tr>
-
-                          <tr>
-                            <td>
-                              <!-- Primary button only -->
-                              <table cellpadding="0" cellspacing="0" border="0" role="presentation">
-                                <tr>
-                                  <td>
-                                    <a href="{{ it.link }}" style="background-color:#0f62fe;border-radius:6px;color:#ffffff;display:inline-block;padding:10px 14px;text-decoration:none;font-weight:600;font-size:13px;">
-                                      Read article →
-                                    </a>
-                                  </td>
-                                </tr>
-                              </table>
-                            </td>
-                          </tr>
-
-                        </table>
-                      </td>
-
-                      <!-- Thumbnail -->
-                      <td class="col" valign="top" style="width:180px;">
-                        {% if it.thumbnail %}
-                          <a href="{{ it.link }}"><img alt="" class="thumbnail" src="{{ it.thumbnail }}" width="170" height="110" style="display:block;border-radius:8px;border:1px solid #eef3fa;object-fit:cover;max-width:100%;height:auto;" /></a>
-                        {% else %}
-                          <div style="width:170px;height:110px;border-radius:8px;border:1px solid #eef3fa;background:#fbfdff;color:#6b7280;display:flex;align-items:center;justify-content:center;font-size:13px;">
-                            {{ it.feed_title or '' }}
-                          </div>
-                        {% endif %}
-                      </td>
-
-                    </tr>
-                  </table>
-                </td>
-              </tr>
-            </table>
-          </td>
-        </tr>
-        {% endfor %}
+        {% for it in items %}{{ it.row_html or item_row(it) }}{% endfor %}
 
         <!-- Full TOC at the bottom (out of the way of the header) -->
         {% if items %}
@@ -170,14 +196,7 @@ HTML_TEMPLATE = """
               <tr>
                 <td style="font-size:14px;color:#0b2a66;font-weight:700;padding-bottom:8px;">Full table of contents</td>
               </tr>
-              {% for it in items %}
-              <tr>
-                <td style="padding:8px 0;border-top:1px solid #f1f5f9;">
-                  <a href="#item-{{ loop.index0 }}" style="color:#0f62fe;text-decoration:none;font-size:14px;">{{ loop.index }}. {{ it.title }}</a>
-                  <div style="color:#8292a6;font-size:12px;margin-top:4px;">{{ it.feed_title or it.feed_url }}</div>
-                </td>
-              </tr>
-              {% endfor %}
+              {% for it in toc or items %}{{ it.toc_html or toc_row(it, loop.index) }}{% endfor %}
             </table>
           </td>
         </tr>
@@ -213,6 +232,38 @@ def _datetimeformat(value: Optional[datetime]) -> str:
     except Exception:
         return str(value)
 
+DIGEST_TEMPLATE_NAME = "digest.html"
+
+_environment: Optional[Environment] = None
+
+def _get_environment() -> Environment:
+    # Built once per process; compiled templates are kept in memory and their
+    # bytecode on disk, so later renders (and later processes) skip compilation
+    global _environment
+    if _environment is None:
+        loaders = []
+        override_dir = getattr(config, "DIGEST_TEMPLATE_DIR", None)
+        if override_dir:
+            loaders.append(FileSystemLoader(override_dir))
+        loaders.append(DictLoader({DIGEST_TEMPLATE_NAME: HTML_TEMPLATE}))
+
+        bytecode_cache = None
+        cache_dir = getattr(config, "TEMPLATE_CACHE_DIR", None)
+        if cache_dir:
+            try:
+                Path(cache_dir).mkdir(parents=True, exist_ok=True)
+                bytecode_cache = FileSystemBytecodeCache(str(cache_dir))
+            except OSError:
+                bytecode_cache = None
+
+        env = Environment(loader=ChoiceLoader(loaders), bytecode_cache=bytecode_cache, auto_reload=bool(override_dir))
+        env.filters["datetimeformat"] = _datetimeformat
+        _environment = env
+    return _environment
+
+def _get_template() -> Template:
+    return _get_environment().get_template(DIGEST_TEMPLATE_NAME)
+
 def _get_origin(url: str) -> str:
     try:
         p = urlparse(url)
@@ -315,104 +366,324 @@ def _truncate_text(s: str, max_chars: int = 600) -> str:
         return s[:cut+1].strip() + "…"
     return s[:max_chars].rstrip() + "…"
 
-def _prepare_item(it: Dict, max_summary_chars: int) -> Dict:
+def _summary_source(it: Dict) -> Tuple[str, str]:
     feed_url = it.get("feed_url") or it.get("feed") or ""
+    summary_html = it.get("summary") or (it.get("raw") or {}).get("summary", "") or ""
+    return feed_url, summary_html
+
+def _prepared_key(it: Dict, max_summary_chars: int) -> str:
+    feed_url, summary_html = _summary_source(it)
+    digest = hashlib.sha256()
+    digest.update(feed_url.encode("utf-8", "surrogatepass"))
+    digest.update(b"\0")
+    digest.update(summary_html.encode("utf-8", "surrogatepass"))
+    return f"v{COMPOSER_VERSION}:{max_summary_chars}:{digest.hexdigest()}"
+
+def derive_fields(it: Dict, max_summary_chars: int = DEFAULT_SUMMARY_CHARS) -> Dict:
+    feed_url, summary_html = _summary_source(it)
     base = _get_origin(feed_url) or feed_url
-    summary_html = it.get("summary") or it.get("raw", {}).get("summary", "") or ""
-    summary_html_abs = _make_urls_absolute(summary_html, base)
-    thumbnail = _extract_first_image(summary_html_abs, base)
-    summary_without_first_img = _strip_first_image_from_html(summary_html_abs)
-    if thumbnail and not re.match(r'^(http:|https:|data:|cid:)', thumbnail, re.I):
-        thumbnail = urljoin(base, thumbnail)
-    summary_text = _strip_tags(summary_without_first_img)
+    summary_without_first_img, thumbnail, summary_text = sanitiser.process_summary(summary_html, base)
     short_summary = _truncate_text(summary_text, max_summary_chars) if max_summary_chars else summary_text
     feed_icon = _favicon_url_for_feed(feed_url) or ""
     return {
-        **it,
         "summary": summary_without_first_img or html.escape(short_summary),
         "summary_text": summary_text,
         "short_summary": short_summary,
         "thumbnail": thumbnail,
         "feed_icon": feed_icon,
+    }
+
+def _cache_get(key: str) -> Optional[Dict]:
+    with _prepared_lock:
+        fields = _prepared_cache.get(key)
+        if fields is not None:
+            _prepared_cache.move_to_end(key)
+        return fields
+
+def _cache_put(key: str, fields: Dict) -> None:
+    with _prepared_lock:
+        _prepared_cache[key] = fields
+        _prepared_cache.move_to_end(key)
+        while len(_prepared_cache) > PREPARED_CACHE_SIZE:
+            _prepared_cache.popitem(last=False)
+
+def remember_prepared(items: List[Dict], derived: List[Dict], max_summary_chars: int) -> None:
+    # Adds fields derived elsewhere (e.g. at ingest, see rss_manager.enrich_articles) to both caches
+    fresh = {}
+    for it, fields in zip(items, derived):
+        key = _prepared_key(it, max_summary_chars)
+        _cache_put(key, fields)
+        fresh[key] = {f: fields[f] for f in PREPARED_FIELDS}
+    if fresh and getattr(config, "PREPARED_CACHE_PERSIST", True) and getattr(config, "DB_URL", None):
+        try:
+            db.put_prepared_items(fresh)
+        except Exception as exc:
+            logger.warning("Failed to store prepared fields: %s", exc)
+
+def _prepare_item(it: Dict, max_summary_chars: int, key: Optional[str] = None) -> Dict:
+    key = key or _prepared_key(it, max_summary_chars)
+    fields = _cache_get(key)
+    if fields is None:
+        fields = derive_fields(it, max_summary_chars)
+        _cache_put(key, fields)
+    return {
+        **it,
+        **fields,
         "feed_title": it.get("feed_title") or it.get("feed_name") or None,
     }
 
-def compose_digest(
-    items: List[Dict],
-    subject_override: Optional[str] = None,
-    max_items: Optional[int] = None,
-    intro: Optional[str] = None,
-    max_summary_chars: int = 600,
-    preheader: Optional[str] = None
-) -> Tuple[str, str, str]:
-    if max_items is not None:
-        items = items[:max_items]
+def _prepare_items(items: List[Dict], max_summary_chars: int) -> List[Dict]:
+    # Memory first, then one round trip to the persistent cache for whatever is left,
+    # then one write for anything that had to be computed
+    keys = [_prepared_key(it, max_summary_chars) for it in items]
+    persist = getattr(config, "PREPARED_CACHE_PERSIST", True) and getattr(config, "DB_URL", None)
+    missing = [k for k in dict.fromkeys(keys) if _cache_get(k) is None]
+    if missing and persist:
+        try:
+            for k, fields in db.get_prepared_items(missing).items():
+                _cache_put(k, fields)
+        except Exception as exc:
+            logger.debug("Prepared-item cache lookup failed: %s", exc)
+    computed = {k for k in missing if _cache_get(k) is None}
+
+    prepared = [_prepare_item(it, max_summary_chars, k) for it, k in zip(items, keys)]
+
+    if computed and persist:
+        fresh = {k: {f: p[f] for f in PREPARED_FIELDS} for k, p in zip(keys, prepared) if k in computed}
+        try:
+            db.put_prepared_items(fresh)
+        except Exception as exc:
+            logger.debug("Prepared-item cache store failed: %s", exc)
+    return prepared
 
-    prepared = [_prepare_item(it, max_summary_chars) for it in items]
+def _feed_name(it: Dict) -> str:
+    return it.get("feed_title") or it.get("feed_name") or it.get("feed_url") or ""
 
+def _feed_entry(it: Dict) -> Tuple[str, str]:
+    name = (_feed_name(it) or "unknown").strip()
+    return name, it.get("feed_icon") or _favicon_url_for_feed(it.get("feed_url"))
+
+def _feed_list(items: Iterable[Dict]) -> List[Dict]:
+    # Works on raw or prepared items: neither needs the summary to be processed
     feed_counts: Dict[str, Dict] = {}
-    for it in prepared:
-        name = (it.get("feed_title") or it.get("feed_url") or "unknown").strip()
-        icon = it.get("feed_icon") or _favicon_url_for_feed(it.get("feed_url"))
+    for it in items:
+        name, icon = _feed_entry(it)
         key = name
         if key not in feed_counts:
             feed_counts[key] = {"name": name, "icon": icon, "count": 0}
         feed_counts[key]["count"] += 1
-    feed_list = list(feed_counts.values())
-
+    return list(feed_counts.values())
+
+def _subject_and_preheader(
+    subject_override: Optional[str],
+    intro: Optional[str],
+    preheader: Optional[str],
+    first: Optional[Dict],
+) -> Tuple[str, str]:
     subject = subject_override or f"{getattr(config, 'SUBJECT_PREFIX', '[RSS]')} Daily Digest — {datetime.now(UTC).date()}"
 
     if not preheader:
         if intro:
             pre = intro.strip()
-        elif prepared and prepared[0].get("short_summary"):
-            pre = prepared[0]["short_summary"][:140]
+        elif first and first.get("short_summary"):
+            pre = first["short_summary"][:140]
         else:
             pre = subject
     else:
         pre = preheader
+    return subject, pre
 
-    tpl = Template(HTML_TEMPLATE)
-    tpl.environment.filters["datetimeformat"] = _datetimeformat
-
-    html_body = tpl.render(
-        subject=subject,
-        items=prepared,
-        intro=intro or "",
-        from_name=getattr(config, "FROM_NAME", "RSS Digest"),
-        generated_at=datetime.now(UTC).strftime("%Y-%m-%d %H:%M UTC"),
-        feed_list=feed_list,
-        preheader=pre,
-    )
+def _template_context(subject: str, items: Iterable[Dict], intro: Optional[str], feed_list: List[Dict], pre: str) -> Dict:
+    return {
+        "subject": subject,
+        "items": items,
+        "intro": intro or "",
+        "from_name": getattr(config, "FROM_NAME", "RSS Digest"),
+        "generated_at": datetime.now(UTC).strftime("%Y-%m-%d %H:%M UTC"),
+        "feed_list": feed_list,
+        "preheader": pre,
+    }
 
+def _text_row(idx: int, it: Dict) -> str:
+    category = f" [{it.get('category')}]" if it.get("category") else ""
+    published = f" · {_datetimeformat(it['published'])}" if it.get("published") else ""
+    title = it.get("title") or ""
+    link = it.get("link") or ""
+    summary = it.get("short_summary") or _strip_tags(it.get("summary_text") or "")
+    return TEXT_ITEM_TMPL.format(
+        index=idx,
+        title=title,
+        feed=_feed_name(it),
+        category=category,
+        published=published,
+        link=link,
+        summary=summary
+    ).rstrip()
+
+def _iter_text(subject: str, items: Iterable[Dict], toc: List[Dict]) -> Iterator[str]:
     toc_lines = []
-    for idx, it in enumerate(prepared, start=1):
-        feed = it.get("feed_title") or it.get("feed_url") or ""
-        toc_lines.append(f"{idx}. {it.get('title')} — {feed}")
+    for idx, it in enumerate(toc, start=1):
+        toc_lines.append(f"{idx}. {it.get('title')} — {_feed_name(it)}")
     toc_text = "\n".join(toc_lines)
-    text_parts = []
+    wrote = False
     if toc_text:
-        text_parts.append(TEXT_TOC.format(count=len(prepared), toc=toc_text))
-
-    for idx, it in enumerate(prepared, start=1):
-        feed = it.get("feed_title") or it.get("feed_url") or ""
-        category = f" [{it.get('category')}]" if it.get("category") else ""
-        published = f" · {_datetimeformat(it['published'])}" if it.get("published") else ""
-        title = it.get("title") or ""
-        link = it.get("link") or ""
-        summary = it.get("short_summary") or _strip_tags(it.get("summary_text") or "")
-        text_parts.append(TEXT_ITEM_TMPL.format(
-            index=idx,
-            title=title,
-            feed=feed,
-            category=category,
-            published=published,
-            link=link,
-            summary=summary
-        ).rstrip())
-
-    text_body = "\n\n".join(text_parts).strip()
-    if not text_body:
-        text_body = f"{subject}\n\nNo new items."
-
-    return subject, html_body, text_body
\ No newline at end of file
+        yield TEXT_TOC.format(count=len(toc), toc=toc_text)
+        wrote = True
+
+    for idx, it in enumerate(items, start=1):
+        if wrote:
+            yield "\n\n"
+        yield it.get("row_text") or _text_row(idx, it)
+        wrote = True
+
+    if not wrote:
+        yield f"{subject}\n\nNo new items."
+
+def compose_digest(
+    items: List[Dict],
+    subject_override: Optional[str] = None,
+    max_items: Optional[int] = None,
+    intro: Optional[str] = None,
+    max_summary_chars: Optional[int] = None,
+    preheader: Optional[str] = None
+) -> Tuple[str, str, str]:
+    if max_summary_chars is None:
+        max_summary_chars = getattr(config, "SUMMARY_CHARS", DEFAULT_SUMMARY_CHARS)
+    if max_items is not None:
+        items = items[:max_items]
+
+    prepared = _prepare_items(items, max_summary_chars)
+    feed_list = _feed_list(prepared)
+    subject, pre = _subject_and_preheader(subject_override, intro, preheader, prepared[0] if prepared else None)
+
+    tpl = _get_template()
+    html_body = tpl.render(**_template_context(subject, prepared, intro, feed_list, pre))
+    text_body = "".join(_iter_text(subject, prepared, prepared)).strip()
+
+    return subject, html_body, text_body
+
+class _LazyPrepared:
+    # Prepares items a batch at a time, through the same memory and persistent caches as
+    # compose_digest(), as the template walks them; only the current batch is held in its
+    # prepared form. Each item's plain-text row is kept so the text body needs no second pass.
+    BATCH = 64
+
+    def __init__(self, items: List[Dict], max_summary_chars: int):
+        self.items = items
+        self.max_summary_chars = max_summary_chars
+        # The first batch is prepared up front: the preheader needs the first item
+        self.first_batch = _prepare_items(items[:self.BATCH], max_summary_chars)
+        self.text_rows: List[str] = []
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def __bool__(self) -> bool:
+        return bool(self.items)
+
+    def first(self) -> Optional[Dict]:
+        return self.first_batch[0] if self.first_batch else None
+
+    def __iter__(self) -> Iterator[Dict]:
+        self.text_rows.clear()
+        for start in range(0, len(self.items), self.BATCH):
+            if start == 0:
+                batch = self.first_batch
+            else:
+                batch = _prepare_items(self.items[start:start + self.BATCH], self.max_summary_chars)
+            for idx, it in enumerate(batch, start=start + 1):
+                self.text_rows.append(_text_row(idx, it))
+                yield it
+
+    def iter_text_rows(self) -> Iterator[Dict]:
+        if len(self.text_rows) < len(self.items):
+            # The HTML has not been rendered first, so walk the items for their text alone
+            for _ in self:
+                pass
+        for row in self.text_rows:
+            yield {"row_text": row}
+
+def compose_digest_stream(
+    items: List[Dict],
+    subject_override: Optional[str] = None,
+    max_items: Optional[int] = None,
+    intro: Optional[str] = None,
+    max_summary_chars: Optional[int] = None,
+    preheader: Optional[str] = None
+) -> Tuple[str, Iterator[str], Iterator[str]]:
+    # Same output as compose_digest(), but the HTML and text bodies come back as generators
+    # of chunks that can be written out without building the whole string. Consume the HTML
+    # first: the text is assembled from rows kept while the HTML was rendered.
+    if max_summary_chars is None:
+        max_summary_chars = getattr(config, "SUMMARY_CHARS", DEFAULT_SUMMARY_CHARS)
+    if max_items is not None:
+        items = items[:max_items]
+
+    lazy = _LazyPrepared(items, max_summary_chars)
+    subject, pre = _subject_and_preheader(subject_override, intro, preheader, lazy.first())
+    toc = [
+        {"title": it.get("title"), "feed_title": it.get("feed_title") or it.get("feed_name"), "feed_url": it.get("feed_url")}
+        for it in items
+    ]
+
+    context = _template_context(subject, lazy, intro, _feed_list(items), pre)
+    context["toc"] = toc
+    html_chunks = _get_template().generate(**context)
+    text_chunks = _iter_text(subject, lazy.iter_text_rows(), toc)
+    return subject, html_chunks, text_chunks
+
+# What a digest draft keeps of each prepared item, so a row can be re-rendered if the template changes
+DRAFT_FIELDS = ("title", "link", "feed_title", "feed_url", "feed_icon", "category", "published", "summary", "thumbnail", "short_summary")
+
+def fragment_version() -> str:
+    # Pre-rendered rows are only reused while the template and derive_fields() are unchanged
+    env = _get_environment()
+    source = env.loader.get_source(env, DIGEST_TEMPLATE_NAME)[0]
+    return hashlib.sha256(f"{COMPOSER_VERSION}\0{source}".encode("utf-8")).hexdigest()[:16]
+
+def render_draft_rows(items: List[Dict], start: int, max_summary_chars: Optional[int] = None) -> List[Dict]:
+    # Renders the digest rows for items that will sit at positions start, start + 1, ... of a draft.
+    # Templates without the item_row/toc_row macros get no HTML rows and are rendered in full at send time.
+    if max_summary_chars is None:
+        max_summary_chars = getattr(config, "SUMMARY_CHARS", DEFAULT_SUMMARY_CHARS)
+    module = _get_template().make_module()
+    item_row = getattr(module, "item_row", None)
+    toc_row = getattr(module, "toc_row", None)
+    version = fragment_version()
+
+    rows = []
+    for idx, it in enumerate(_prepare_items(items, max_summary_chars), start=start):
+        fields = {f: it.get(f) for f in DRAFT_FIELDS}
+        feed, feed_icon = _feed_entry(it)
+        rows.append({
+            "position": idx,
+            "item": fields,
+            "feed": feed,
+            "feed_icon": feed_icon,
+            "row_html": str(item_row(it)) if item_row else None,
+            "toc_html": str(toc_row(it, idx)) if toc_row else None,
+            "row_text": _text_row(idx, it),
+            "version": version,
+        })
+    return rows
+
+def compose_draft(
+    draft: Dict,
+    subject_override: Optional[str] = None,
+    intro: Optional[str] = None,
+    preheader: Optional[str] = None
+) -> Tuple[str, str, str]:
+    # Finalises a draft (see drafts.load_draft): only the header, feed summary and footer are
+    # rendered here, around the rows that were rendered as the items arrived
+    version = fragment_version()
+    items = []
+    for row in draft["items"]:
+        it = dict(row["item"])
+        if row["version"] == version:
+            it.update(row_html=row["row_html"], toc_html=row["toc_html"], row_text=row["row_text"])
+        items.append(it)
+
+    subject, pre = _subject_and_preheader(subject_override, intro, preheader, items[0] if items else None)
+    html_body = _get_template().render(**_template_context(subject, items, intro, draft["feeds"], pre))
+    text_body = "".join(_iter_text(subject, items, items)).strip()
+    return subject, html_body, text_body
@@ -41,6 +41,21 @@ USE_BCC = _bool(os.environ.get("USE_BCC"), True)
 DRY_RUN = _bool(os.environ.get("DRY_RUN"), True)
 SKIP_SMTP_AUTH = _bool(os.environ.get("SKIP_SMTP_AUTH"), False)
 
+SMTP_POOL_SIZE = _int_or_none(os.environ.get("SMTP_POOL_SIZE")) or 4
+SMTP_MAX_RETRIES = _int_or_none(os.environ.get("SMTP_MAX_RETRIES"))
+if SMTP_MAX_RETRIES is None:
+    SMTP_MAX_RETRIES = 3
+SMTP_MESSAGES_PER_CONNECTION = _int_or_none(os.environ.get("SMTP_MESSAGES_PER_CONNECTION"))
+if SMTP_MESSAGES_PER_CONNECTION is None:
+    SMTP_MESSAGES_PER_CONNECTION = 100
+SMTP_BCC_BATCH_SIZE = _int_or_none(os.environ.get("SMTP_BCC_BATCH_SIZE")) or 50
+LIST_UNSUBSCRIBE = os.environ.get("LIST_UNSUBSCRIBE") or None
+
+OUTBOX = _bool(os.environ.get("OUTBOX"), True)
+OUTBOX_BATCH_SIZE = _int_or_none(os.environ.get("OUTBOX_BATCH_SIZE")) or 100
+OUTBOX_MAX_ATTEMPTS = _int_or_none(os.environ.get("OUTBOX_MAX_ATTEMPTS")) or 5
+OUTBOX_RETRY_BACKOFF = _int_or_none(os.environ.get("OUTBOX_RETRY_BACKOFF")) or 60
+
 MAX_ENTRIES_PER_FEED = _int_or_none(os.environ.get("MAX_ENTRIES_PER_FEED"))
 MAX_ITEMS = _int_or_none(os.environ.get("MAX_ITEMS"))
 
@@ -48,4 +63,35 @@ FEED_URLS = [u.strip() for u in os.environ.get("FEED_URLS", "").split(",") if u.
 
 TEST_EMAIL = os.environ.get("TEST_EMAIL")
 
-ADMIN_PASSWORD = os.environ.get("ADMIN_PASSWORD", "")
\ No newline at end of file
+ADMIN_PASSWORD = os.environ.get("ADMIN_PASSWORD", "")
+
+ENRICH_AT_INGEST = _bool(os.environ.get("ENRICH_AT_INGEST"), True)
+SUMMARY_CHARS = _int_or_none(os.environ.get("SUMMARY_CHARS")) or 600
+PREPARED_CACHE_PERSIST = _bool(os.environ.get("PREPARED_CACHE_PERSIST"), True)
+STREAM_COMPOSE = _bool(os.environ.get("STREAM_COMPOSE"), False)
+INCREMENTAL_DIGEST = _bool(os.environ.get("INCREMENTAL_DIGEST"), False)
+DIGEST_PRECOMPRESS = _bool(os.environ.get("DIGEST_PRECOMPRESS"), True)
+DIGEST_ARCHIVE = os.environ.get("DIGEST_ARCHIVE", "gzip")
+DIGEST_TEMPLATE_DIR = os.environ.get("DIGEST_TEMPLATE_DIR") or None
+TEMPLATE_CACHE_DIR = os.environ.get("TEMPLATE_CACHE_DIR", ".cache/jinja")
+
+FETCH_WORKERS = _int_or_none(os.environ.get("FETCH_WORKERS")) or 16
+FETCH_PER_HOST = _int_or_none(os.environ.get("FETCH_PER_HOST")) or 2
+KNOWN_LINKS_PER_FEED = _int_or_none(os.environ.get("KNOWN_LINKS_PER_FEED"))
+if KNOWN_LINKS_PER_FEED is None:
+    KNOWN_LINKS_PER_FEED = 500
+STOP_AFTER_KNOWN = _int_or_none(os.environ.get("STOP_AFTER_KNOWN"))
+ADAPTIVE_POLLING = _bool(os.environ.get("ADAPTIVE_POLLING"), True)
+POLL_MIN_INTERVAL = _int_or_none(os.environ.get("POLL_MIN_INTERVAL")) or 300
+POLL_MAX_INTERVAL = _int_or_none(os.environ.get("POLL_MAX_INTERVAL")) or 43200
+POLL_ERROR_MAX_INTERVAL = _int_or_none(os.environ.get("POLL_ERROR_MAX_INTERVAL")) or 86400
+PARSE_PROCESSES = _int_or_none(os.environ.get("PARSE_PROCESSES")) or 0
+KEEP_RAW_ENTRIES = _bool(os.environ.get("KEEP_RAW_ENTRIES"), False)
+ASYNC_PIPELINE = _bool(os.environ.get("ASYNC_PIPELINE"), False)
+
+DB_POOL_MIN = _int_or_none(os.environ.get("DB_POOL_MIN")) or 1
+DB_POOL_MAX = _int_or_none(os.environ.get("DB_POOL_MAX")) or 10
+DB_POOL_CHECK_INTERVAL = _int_or_none(os.environ.get("DB_POOL_CHECK_INTERVAL")) or 30
+RUN_LOCK_WAIT = _int_or_none(os.environ.get("RUN_LOCK_WAIT"))
+if RUN_LOCK_WAIT is None:
+    RUN_LOCK_WAIT = 1800
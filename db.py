@@ -1,74 +1,231 @@
 ## Handles all database operations
 
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import UTC
+from typing import Dict
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, Json, execute_values
+from psycopg2.pool import ThreadedConnectionPool
+import config
 from config import DB_URL
 
-def get_connection():
-    conn = psycopg2.connect(DB_URL)
-    return conn
+_pool = None
+_pool_pid = None
+_pool_slots = None
+_pool_lock = threading.Lock()
+_last_used: Dict[int, float] = {}
+_stats = {"checkouts": 0, "in_use": 0, "discarded": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0}
+
+def _get_pool():
+    global _pool, _pool_pid, _pool_slots
+    with _pool_lock:
+        # A forked worker (e.g. gunicorn) must not share its parent's sockets
+        if _pool is None or _pool_pid != os.getpid():
+            if not DB_URL:
+                raise RuntimeError("DB_URL not configured")
+            min_size = getattr(config, "DB_POOL_MIN", 1)
+            # A run holds one connection for its lock (see run_lock) and needs another to work
+            max_size = max(min_size, getattr(config, "DB_POOL_MAX", 10), 2)
+            _pool = ThreadedConnectionPool(min_size, max_size, DB_URL)
+            _pool_pid = os.getpid()
+            _pool_slots = threading.BoundedSemaphore(max_size)
+            _last_used.clear()
+        return _pool, _pool_slots
+
+def _is_healthy(conn) -> bool:
+    if conn.closed:
+        return False
+    interval = getattr(config, "DB_POOL_CHECK_INTERVAL", 30)
+    if time.monotonic() - _last_used.get(id(conn), 0.0) < interval:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except Exception:
+        return False
+
+def _checkout(pool):
+    for _ in range(pool.maxconn + 1):
+        conn = pool.getconn()
+        if _is_healthy(conn):
+            return conn
+        _last_used.pop(id(conn), None)
+        pool.putconn(conn, close=True)
+        with _pool_lock:
+            _stats["discarded"] += 1
+    raise psycopg2.OperationalError("Could not get a healthy connection from the pool")
+
+@contextmanager
+def connection():
+    # Borrow a pooled connection; blocks while all DB_POOL_MAX connections are in use
+    pool, slots = _get_pool()
+    started = time.monotonic()
+    slots.acquire()
+    conn = None
+    try:
+        conn = _checkout(pool)
+        waited = time.monotonic() - started
+        with _pool_lock:
+            _stats["checkouts"] += 1
+            _stats["in_use"] += 1
+            _stats["wait_seconds"] += waited
+            _stats["max_wait_seconds"] = max(_stats["max_wait_seconds"], waited)
+        yield conn
+    finally:
+        if conn is not None:
+            with _pool_lock:
+                _stats["in_use"] -= 1
+            _last_used[id(conn)] = time.monotonic()
+            try:
+                pool.putconn(conn, close=conn.closed != 0)
+            except Exception:
+                pass
+        slots.release()
+
+# Arbitrary application-wide key for the advisory lock taken by run_lock()
+RUN_LOCK_KEY = 0x7273_7364
+
+@contextmanager
+def run_lock(wait: float = 0):
+    # Yields True if this process now holds the cluster-wide "digest run" lock, False if
+    # another process (cron or a web worker) still held it after waiting up to `wait` seconds.
+    # Held on one pooled connection for the whole run, so DB_POOL_MAX must be at least 2.
+    with connection() as conn:
+        cur = conn.cursor()
+        if wait > 0:
+            cur.execute("SET LOCAL lock_timeout = %s", (f"{int(wait * 1000)}ms",))
+            try:
+                cur.execute("SELECT pg_advisory_lock(%s)", (RUN_LOCK_KEY,))
+                acquired = True
+            except psycopg2.errors.LockNotAvailable:
+                conn.rollback()
+                acquired = False
+        else:
+            cur.execute("SELECT pg_try_advisory_lock(%s)", (RUN_LOCK_KEY,))
+            acquired = cur.fetchone()[0]
+        conn.commit()
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                try:
+                    cur.execute("SELECT pg_advisory_unlock(%s)", (RUN_LOCK_KEY,))
+                    conn.commit()
+                except Exception:
+                    # Session locks die with the connection, so make sure it is not reused
+                    conn.close()
+            cur.close()
+
+def pool_stats() -> Dict:
+    with _pool_lock:
+        stats = dict(_stats)
+        stats["idle"] = len(getattr(_pool, "_pool", []) or []) if _pool is not None else 0
+    stats["min_size"] = getattr(config, "DB_POOL_MIN", 1)
+    stats["max_size"] = getattr(config, "DB_POOL_MAX", 10)
+    return stats
+
+def close_pool() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.closeall()
+        _pool = None
+        _last_used.clear()
 
 def init_db():
-    conn = get_connection()
-    cur = conn.cursor()
+    with connection() as conn:
+        cur = conn.cursor()
 
-    # Table to hold RSS feeds
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS feeds (
-            id SERIAL PRIMARY KEY,
-            url TEXT NOT NULL UNIQUE,
-            category TEXT,
-            enabled BOOLEAN DEFAULT TRUE NOT NULL,
-            added_at TIMESTAMP NOT NULL DEFAULT NOW()
-        )
-    """)
+        # Table to hold RSS feeds
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS feeds (
+                id SERIAL PRIMARY KEY,
+                url TEXT NOT NULL UNIQUE,
+                category TEXT,
+                enabled BOOLEAN DEFAULT TRUE NOT NULL,
+                added_at TIMESTAMP NOT NULL DEFAULT NOW()
+            )
+        """)
 
-    # Articles
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS articles (
-            id SERIAL PRIMARY KEY,
-            feed_id INTEGER REFERENCES feeds(id) ON DELETE CASCADE,
-            title TEXT NOT NULL,
-            link TEXT NOT NULL,
-            summary TEXT,
-            ai_summary TEXT,
-            published TIMESTAMP,
-            sent BOOLEAN DEFAULT FALSE NOT NULL,
-            UNIQUE(feed_id, link)
-        )
-    """)
+        # Conditional GET state for each feed
+        cur.execute("""
+            ALTER TABLE feeds
+                ADD COLUMN IF NOT EXISTS etag TEXT,
+                ADD COLUMN IF NOT EXISTS last_modified TEXT,
+                ADD COLUMN IF NOT EXISTS last_status INTEGER,
+                ADD COLUMN IF NOT EXISTS last_fetched_at TIMESTAMP
+        """)
 
-    # Table to hold settings
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS settings (
-            key TEXT PRIMARY KEY,
-            value TEXT
-        )
-    """)
+        # Adaptive polling schedule (see scheduler.py)
+        cur.execute("""
+            ALTER TABLE feeds
+                ADD COLUMN IF NOT EXISTS next_due_at TIMESTAMP,
+                ADD COLUMN IF NOT EXISTS last_changed_at TIMESTAMP,
+                ADD COLUMN IF NOT EXISTS avg_interval_secs DOUBLE PRECISION,
+                ADD COLUMN IF NOT EXISTS unchanged_streak INTEGER NOT NULL DEFAULT 0,
+                ADD COLUMN IF NOT EXISTS error_streak INTEGER NOT NULL DEFAULT 0
+        """)
+
+        # Articles
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS articles (
+                id SERIAL PRIMARY KEY,
+                feed_id INTEGER REFERENCES feeds(id) ON DELETE CASCADE,
+                title TEXT NOT NULL,
+                link TEXT NOT NULL,
+                summary TEXT,
+                ai_summary TEXT,
+                published TIMESTAMP,
+                sent BOOLEAN DEFAULT FALSE NOT NULL,
+                UNIQUE(feed_id, link)
+            )
+        """)
+
+        # Derived fields for composed articles, keyed by content hash (see composer._prepared_key)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS prepared_items (
+                cache_key TEXT PRIMARY KEY,
+                fields JSONB NOT NULL,
+                created_at TIMESTAMP NOT NULL DEFAULT NOW()
+            )
+        """)
+        cur.execute("DELETE FROM prepared_items WHERE created_at < NOW() - INTERVAL '90 days'")
 
-    conn.commit()
-    cur.close()
-    conn.close()
+        _create_digests_table(cur)
+
+        # Table to hold settings
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS settings (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        """)
+
+        conn.commit()
+        cur.close()
 
 def get_feeds(enabled_only=True):
-    conn = get_connection()
-    cur = conn.cursor()
-    if enabled_only:
-        cur.execute("SELECT * FROM feeds WHERE enabled = TRUE ORDER BY added_at")
-    else:
-        cur.execute("SELECT * FROM feeds ORDER BY added_at")
-    feeds = cur.fetchall()
-    cur.close()
-    conn.close()
+    with connection() as conn:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        if enabled_only:
+            cur.execute("SELECT * FROM feeds WHERE enabled = TRUE ORDER BY added_at")
+        else:
+            cur.execute("SELECT * FROM feeds ORDER BY added_at")
+        feeds = cur.fetchall()
+        cur.close()
     return feeds
 
 def add_feed(url, category=None):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("INSERT INTO feeds (url, category) VALUES (%s, %s) ON CONFLICT (url) DO NOTHING", (url, category))
-    conn.commit()
-    cur.close()
-    conn.close()
+    with connection() as conn:
+        cur = conn.cursor()
+        cur.execute("INSERT INTO feeds (url, category) VALUES (%s, %s) ON CONFLICT (url) DO NOTHING", (url, category))
+        conn.commit()
+        cur.close()
 
 def update_feed(feed_id, **kwargs):
     options = ["url", "category", "enabled"]
@@ -76,59 +233,269 @@ def update_feed(feed_id, **kwargs):
     values = [v for k, v in kwargs.items() if k in options]
     if not updates:
         return
-    conn = get_connection()
-    cur = conn.cursor()
-    query = f"UPDATE feeds SET {updates} WHERE id = %s"
-    cur.execute(query, values + [feed_id])
-    conn.commit()
-    cur.close()
-    conn.close()
+    with connection() as conn:
+        cur = conn.cursor()
+        query = f"UPDATE feeds SET {updates} WHERE id = %s"
+        cur.execute(query, values + [feed_id])
+        conn.commit()
+        cur.close()
+
+def update_feed_state(feed_id, **kwargs):
+    options = [
+        "etag", "last_modified", "last_status",
+        "next_due_at", "last_changed_at", "avg_interval_secs", "unchanged_streak", "error_streak",
+    ]
+    updates = [f"{k} = %s" for k in kwargs if k in options]
+    values = [v for k, v in kwargs.items() if k in options]
+    with connection() as conn:
+        cur = conn.cursor()
+        query = f"UPDATE feeds SET {', '.join(updates + ['last_fetched_at = NOW()'])} WHERE id = %s"
+        cur.execute(query, values + [feed_id])
+        conn.commit()
+        cur.close()
 
 def delete_feed(feed_id):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM feeds WHERE id = %s", (feed_id,))
-    conn.commit()
-    cur.close()
-    conn.close()
+    with connection() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM feeds WHERE id = %s", (feed_id,))
+        conn.commit()
+        cur.close()
 
 def article_exists(feed_id, link):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT 1 FROM articles WHERE feed_id = %s AND link = %s", (feed_id, link))
-    exists = cur.fetchone() is not None
-    cur.close()
-    conn.close()
+    with connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT 1 FROM articles WHERE feed_id = %s AND link = %s", (feed_id, link))
+        exists = cur.fetchone() is not None
+        cur.close()
     return exists
 
 def add_article(feed_id, title, link, summary=None, ai_summary=None, published=None):
-    conn = get_connection()
-    cur = conn.cursor()
+    with connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            INSERT INTO articles (feed_id, title, link, summary, ai_summary, published)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            ON CONFLICT (feed_id, link) DO NOTHING
+        """, (feed_id, title, link, summary, ai_summary, published))
+        conn.commit()
+        cur.close()
+
+def get_known_links(feed_ids, per_feed_limit=500):
+    # The most recently stored links of each feed, in one round trip
+    ids = sorted({int(i) for i in feed_ids if i is not None})
+    known = {i: set() for i in ids}
+    if not ids:
+        return known
+    with connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT feed_id, link FROM (
+                SELECT feed_id, link, ROW_NUMBER() OVER (PARTITION BY feed_id ORDER BY id DESC) AS rn
+                FROM articles
+                WHERE feed_id = ANY(%s)
+            ) recent
+            WHERE rn <= %s
+        """, (ids, per_feed_limit))
+        for feed_id, link in cur.fetchall():
+            known[feed_id].add(link)
+        cur.close()
+    return known
+
+def add_articles(feed_id, articles):
+    # Insert a feed's entries in one statement and return the rows that were actually new
+    rows = []
+    seen = set()
+    for a in articles:
+        link = a.get("link") or ""
+        if link in seen:
+            continue
+        seen.add(link)
+        rows.append((feed_id, a.get("title") or "", link, a.get("summary"), a.get("ai_summary"), a.get("published")))
+    if not rows:
+        return []
+    with connection() as conn:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        inserted = execute_values(cur, """
+            INSERT INTO articles (feed_id, title, link, summary, ai_summary, published)
+            VALUES %s
+            ON CONFLICT (feed_id, link) DO NOTHING
+            RETURNING id, link
+        """, rows, page_size=len(rows), fetch=True)
+        conn.commit()
+        cur.close()
+    return [dict(r) for r in inserted]
+
+def mark_articles_sent(article_ids):
+    ids = sorted({int(i) for i in article_ids if i is not None})
+    if not ids:
+        return 0
+    with connection() as conn:
+        cur = conn.cursor()
+        cur.execute("UPDATE articles SET sent = TRUE WHERE id = ANY(%s) AND sent = FALSE", (ids,))
+        updated = cur.rowcount
+        conn.commit()
+        cur.close()
+    return updated
+
+def mark_articles_sent_by_link(pairs):
+    # Fallback for articles without an id; joins on the UNIQUE(feed_id, link) index.
+    # Pairs without a feed_id match articles that have no feed either, by link.
+    keyed = [(f, l) for f, l in pairs if f is not None and l]
+    links = sorted({l for f, l in pairs if f is None and l})
+    if not keyed and not links:
+        return 0
+    updated = 0
+    with connection() as conn:
+        cur = conn.cursor()
+        if keyed:
+            cur.execute("""
+                UPDATE articles a SET sent = TRUE
+                FROM unnest(%s::integer[], %s::text[]) AS v(feed_id, link)
+                WHERE a.feed_id = v.feed_id AND a.link = v.link AND a.sent = FALSE
+            """, ([f for f, _ in keyed], [l for _, l in keyed]))
+            updated += cur.rowcount
+        if links:
+            cur.execute("UPDATE articles SET sent = TRUE WHERE feed_id IS NULL AND link = ANY(%s::text[]) AND sent = FALSE", (links,))
+            updated += cur.rowcount
+        conn.commit()
+        cur.close()
+    return updated
+
+def get_prepared_items(keys):
+    if not keys:
+        return {}
+    with connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT cache_key, fields FROM prepared_items WHERE cache_key = ANY(%s)", (list(keys),))
+        found = {k: v for k, v in cur.fetchall()}
+        cur.close()
+    return found
+
+def put_prepared_items(items):
+    if not items:
+        return
+    with connection() as conn:
+        cur = conn.cursor()
+        execute_values(cur, """
+            INSERT INTO prepared_items (cache_key, fields) VALUES %s
+            ON CONFLICT (cache_key) DO NOTHING
+        """, [(k, Json(v)) for k, v in items.items()], page_size=len(items))
+        conn.commit()
+        cur.close()
+
+def _create_digests_table(cur):
+    # Catalogue of written digests (the HTML itself stays in digests/); newest first by id
     cur.execute("""
-        INSERT INTO articles (feed_id, title, link, summary, ai_summary, published)
-        VALUES (%s, %s, %s, %s, %s, %s)
-        ON CONFLICT (feed_id, link) DO NOTHING
-    """, (feed_id, title, link, summary, ai_summary, published))
-    conn.commit()
-    cur.close()
-    conn.close()
+        CREATE TABLE IF NOT EXISTS digests (
+            id SERIAL PRIMARY KEY,
+            subject TEXT NOT NULL,
+            filename TEXT NOT NULL UNIQUE,
+            item_count INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+    """)
+    # Set for digests kept in the compressed archive (see storage.OBJECTS_DIR)
+    cur.execute("""
+        ALTER TABLE digests
+            ADD COLUMN IF NOT EXISTS content_hash TEXT,
+            ADD COLUMN IF NOT EXISTS encoding TEXT
+    """)
+
+def ensure_digests_table():
+    with connection() as conn:
+        cur = conn.cursor()
+        _create_digests_table(cur)
+        conn.commit()
+        cur.close()
+
+def _digest_row(row):
+    entry = dict(row)
+    stamp = entry["created_at"].astimezone(UTC).strftime("%Y-%m-%d %H:%M UTC")
+    entry["timestamp"] = stamp
+    entry["generated_at"] = stamp
+    return entry
+
+def add_digest(subject, filename, item_count, content_hash=None, encoding=None):
+    with connection() as conn:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute("""
+            INSERT INTO digests (subject, filename, item_count, content_hash, encoding) VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (filename) DO UPDATE SET
+                subject = EXCLUDED.subject, item_count = EXCLUDED.item_count,
+                content_hash = EXCLUDED.content_hash, encoding = EXCLUDED.encoding
+            RETURNING *
+        """, (subject, filename, item_count, content_hash, encoding))
+        row = cur.fetchone()
+        conn.commit()
+        cur.close()
+    return _digest_row(row)
+
+def import_digests(entries):
+    # entries: (subject, filename, item_count, created_at), oldest first so ids keep their order
+    if not entries:
+        return 0
+    with connection() as conn:
+        cur = conn.cursor()
+        execute_values(cur, """
+            INSERT INTO digests (subject, filename, item_count, created_at) VALUES %s
+            ON CONFLICT (filename) DO NOTHING
+        """, entries, page_size=1000)
+        imported = cur.rowcount
+        conn.commit()
+        cur.close()
+    return imported
+
+def get_latest_digest():
+    with connection() as conn:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute("SELECT * FROM digests ORDER BY id DESC LIMIT 1")
+        row = cur.fetchone()
+        cur.close()
+    return _digest_row(row) if row else None
+
+def get_digest(filename):
+    with connection() as conn:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute("SELECT * FROM digests WHERE filename = %s", (filename,))
+        row = cur.fetchone()
+        cur.close()
+    return _digest_row(row) if row else None
+
+def list_digests(limit, before_id=None):
+    # Keyset pagination on the primary key: every page costs the same, however deep
+    with connection() as conn:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        if before_id is None:
+            cur.execute("SELECT * FROM digests ORDER BY id DESC LIMIT %s", (limit,))
+        else:
+            cur.execute("SELECT * FROM digests WHERE id < %s ORDER BY id DESC LIMIT %s", (before_id, limit))
+        rows = cur.fetchall()
+        cur.close()
+    return [_digest_row(r) for r in rows]
+
+def delete_digest(filename):
+    with connection() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM digests WHERE filename = %s", (filename,))
+        deleted = cur.rowcount
+        conn.commit()
+        cur.close()
+    return deleted
 
 def get_setting(key, default=None):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT value FROM settings WHERE key = %s", (key,))
-    result = cur.fetchone()
-    cur.close()
-    conn.close()
+    with connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT value FROM settings WHERE key = %s", (key,))
+        result = cur.fetchone()
+        cur.close()
     return result[0] if result else default
 
 def set_setting(key, value):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO settings (key, value) VALUES (%s, %s)
-        ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value
-    """, (key, value))
-    conn.commit()
-    cur.close()
-    conn.close()
\ No newline at end of file
+    with connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            INSERT INTO settings (key, value) VALUES (%s, %s)
+            ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value
+        """, (key, value))
+        conn.commit()
+        cur.close()
\ No newline at end of file
@@ -0,0 +1,162 @@
+## Keeps the next digest partly composed between runs: ingest runs append rendered rows, the send run finalises it
+
+import os
+import logging
+from datetime import datetime
+from psycopg2.extras import RealDictCursor, Json, execute_values
+from typing import Any, Dict, List, Optional
+import config
+import db
+import composer
+
+logger = logging.getLogger(__name__)
+
+DB_URL = getattr(config, "DB_URL", None) or os.environ.get("DB_URL")
+
+def _get_conn():
+    if not DB_URL:
+        raise RuntimeError("DB_URL not configured; cannot access digest draft tables")
+    return db.connection()
+
+def ensure_table():
+    sql = """
+    CREATE TABLE IF NOT EXISTS digest_drafts (
+    id SERIAL PRIMARY KEY,
+    item_count INTEGER NOT NULL DEFAULT 0,
+    articles JSONB NOT NULL DEFAULT '[]',
+    created_at TIMESTAMPTZ DEFAULT now(),
+    updated_at TIMESTAMPTZ DEFAULT now(),
+    closed_at TIMESTAMPTZ,
+    filename TEXT
+    );
+    CREATE UNIQUE INDEX IF NOT EXISTS digest_drafts_open_idx ON digest_drafts ((closed_at IS NULL)) WHERE closed_at IS NULL;
+    CREATE TABLE IF NOT EXISTS digest_draft_items (
+    draft_id INTEGER NOT NULL REFERENCES digest_drafts(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    item JSONB NOT NULL,
+    row_html TEXT,
+    toc_html TEXT,
+    row_text TEXT NOT NULL,
+    version TEXT NOT NULL,
+    PRIMARY KEY (draft_id, position)
+    );
+    CREATE TABLE IF NOT EXISTS digest_draft_feeds (
+    draft_id INTEGER NOT NULL REFERENCES digest_drafts(id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    icon TEXT,
+    count INTEGER NOT NULL DEFAULT 0,
+    position INTEGER NOT NULL,
+    PRIMARY KEY (draft_id, name)
+    );
+    DELETE FROM digest_drafts WHERE closed_at < now() - INTERVAL '30 days';
+    """
+    with _get_conn() as conn:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute(sql)
+
+def _item_json(item: Dict[str, Any]) -> Dict[str, Any]:
+    published = item.get("published")
+    if isinstance(published, datetime):
+        item = dict(item, published=published.isoformat())
+    return item
+
+def _item_from_json(item: Dict[str, Any]) -> Dict[str, Any]:
+    published = item.get("published")
+    if isinstance(published, str):
+        try:
+            item = dict(item, published=datetime.fromisoformat(published))
+        except ValueError:
+            pass
+    return item
+
+def _open_draft() -> Dict[str, Any]:
+    # The unique index allows a single open draft; it is created on first use
+    with _get_conn() as conn:
+        with conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute("""
+                    INSERT INTO digest_drafts DEFAULT VALUES
+                    ON CONFLICT ((closed_at IS NULL)) WHERE closed_at IS NULL DO NOTHING;
+                    SELECT id, item_count FROM digest_drafts WHERE closed_at IS NULL;
+                """)
+                return dict(cur.fetchone())
+
+def append(articles: List[Dict[str, Any]], max_items: Optional[int] = None) -> int:
+    # Renders the articles' rows and adds them to the open draft, along with the feed counts.
+    # Articles past max_items are still recorded, so they are marked sent with the digest.
+    # Returns the number of rows added.
+    if not articles:
+        return 0
+    draft = _open_draft()
+    start = draft["item_count"]
+    room = len(articles) if max_items is None else max(max_items - start, 0)
+    rows = composer.render_draft_rows(articles[:room], start + 1)
+
+    feeds: Dict[str, Dict[str, Any]] = {}
+    for r in rows:
+        feed = feeds.setdefault(r["feed"], {"icon": r["feed_icon"], "count": 0, "position": r["position"]})
+        feed["count"] += 1
+    refs = [{"id": a.get("id"), "feed_id": a.get("feed_id"), "link": a.get("link")} for a in articles]
+
+    with _get_conn() as conn:
+        with conn:
+            with conn.cursor() as cur:
+                # Runs are serialised by db.run_lock(), so this only trips if that was bypassed
+                cur.execute("""
+                    UPDATE digest_drafts SET item_count = item_count + %s, articles = articles || %s, updated_at = now()
+                    WHERE id = %s AND item_count = %s AND closed_at IS NULL;
+                """, (len(rows), Json(refs), draft["id"], start))
+                if cur.rowcount != 1:
+                    raise RuntimeError(f"digest draft {draft['id']} changed while appending to it")
+                if rows:
+                    execute_values(cur, """
+                        INSERT INTO digest_draft_items (draft_id, position, item, row_html, toc_html, row_text, version) VALUES %s
+                    """, [(draft["id"], r["position"], Json(_item_json(r["item"])), r["row_html"], r["toc_html"], r["row_text"], r["version"])
+                          for r in rows], page_size=1000)
+                    execute_values(cur, """
+                        INSERT INTO digest_draft_feeds (draft_id, name, icon, count, position) VALUES %s
+                        ON CONFLICT (draft_id, name) DO UPDATE SET count = digest_draft_feeds.count + EXCLUDED.count
+                    """, [(draft["id"], name, f["icon"], f["count"], f["position"]) for name, f in feeds.items()])
+    logger.info("Added %d of %d articles to digest draft %d (%d items)", len(rows), len(articles), draft["id"], start + len(rows))
+    return len(rows)
+
+def has_open_draft() -> bool:
+    with _get_conn() as conn:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT EXISTS (SELECT 1 FROM digest_drafts WHERE closed_at IS NULL AND articles <> '[]');")
+                return cur.fetchone()[0]
+
+def load_draft() -> Optional[Dict[str, Any]]:
+    # The open draft with its rows in order and its feed summary, or None if nothing is pending
+    with _get_conn() as conn:
+        with conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute("SELECT id, item_count, articles FROM digest_drafts WHERE closed_at IS NULL;")
+                draft = cur.fetchone()
+                if draft is None or not draft["articles"]:
+                    return None
+                draft = dict(draft)
+                cur.execute("""
+                    SELECT item, row_html, toc_html, row_text, version FROM digest_draft_items
+                    WHERE draft_id = %s ORDER BY position;
+                """, (draft["id"],))
+                draft["items"] = [dict(r, item=_item_from_json(r["item"])) for r in cur.fetchall()]
+                cur.execute("SELECT name, icon, count FROM digest_draft_feeds WHERE draft_id = %s ORDER BY position;", (draft["id"],))
+                draft["feeds"] = [dict(r) for r in cur.fetchall()]
+                return draft
+
+def close(draft_id: int, filename: Optional[str] = None, cur=None) -> None:
+    # Called once the finalised digest has been sent or queued; later articles start a new draft.
+    # Pass `cur` to close it inside the caller's transaction (as outbox.enqueue() does).
+    if cur is None:
+        with _get_conn() as conn:
+            with conn:
+                with conn.cursor() as cur:
+                    close(draft_id, filename, cur)
+        return
+    cur.execute("""
+        UPDATE digest_drafts SET closed_at = now(), filename = %s WHERE id = %s AND closed_at IS NULL;
+    """, (filename, draft_id))
+    cur.execute("DELETE FROM digest_draft_items WHERE draft_id = %s;", (draft_id,))
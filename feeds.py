@@ -1,8 +1,13 @@
 ## Fetches new posts on the RSS feeds and handles/processes them
 
+from concurrent.futures import Executor, ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime
+import pickle
+import threading
 import time
-from typing import List, Dict, Optional, Any
+from typing import List, Dict, Optional, Any, Container
+from urllib.parse import urlparse
 import feedparser
 import requests
 
@@ -16,7 +21,27 @@ def _parse_datetime_from_struct(t) -> Optional[datetime]:
     except Exception:
         return None
 
-def normalise_entry(e: Any) -> Dict:
+@dataclass(slots=True)
+class FeedEntry:
+    # Just the fields the pipeline uses; the feedparser entry is only kept on request
+    guid: str
+    title: str
+    link: str
+    summary: str
+    published: Optional[datetime] = None
+    raw: Any = None
+
+    def get(self, key: str, default: Any = None) -> Any:
+        value = getattr(self, key, None)
+        return default if value is None else value
+
+    def __getitem__(self, key: str) -> Any:
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+def normalise_entry(e: Any, keep_raw: bool = False) -> FeedEntry:
     guid = e.get("id") or e.get("guid") or e.get("link") or e.get("title") or ""
     title = (e.get("title") or "").strip()
     link = e.get("link") or ""
@@ -26,22 +51,88 @@ def normalise_entry(e: Any) -> Dict:
         published = _parse_datetime_from_struct(e.published_parsed)
     elif e.get("updated_parsed"):
         published = _parse_datetime_from_struct(e.updated_parsed)
-    return {
-        "guid": str(guid),
-        "title": title,
-        "link": link,
-        "summary": summary,
-        "published": published,
-        "raw": e,
-    }
+    return FeedEntry(
+        guid=str(guid),
+        title=title,
+        link=link,
+        summary=summary,
+        published=published,
+        raw=e if keep_raw else None,
+    )
+
+def _is_known(e: Any, known: Container[str]) -> bool:
+    # `known` holds stored article links (see db.get_known_links); guids are not stored
+    link = e.get("link")
+    return bool(link) and link in known
+
+def parse_entries(
+    content: bytes,
+    max_entries: Optional[int] = None,
+    keep_raw: bool = False,
+    known: Optional[Container[str]] = None,
+    stop_after_known: Optional[int] = None,
+) -> Dict:
+    d = feedparser.parse(content)
+
+    bozo = getattr(d, "bozo", False)
+    bozo_exc = getattr(d, "bozo_exception", None)
+
+    entries_raw = getattr(d, "entries", []) or d.get("entries", [])
+    entries: List[FeedEntry] = []
+    # Known entries are skipped before normalisation but still count towards
+    # max_entries, so the window of entries considered matches an unfiltered fetch
+    skipped = 0
+    known_run = 0
+    for e in entries_raw:
+        if known and _is_known(e, known):
+            skipped += 1
+            known_run += 1
+            if stop_after_known and known_run >= stop_after_known:
+                break
+            if max_entries and len(entries) + skipped >= max_entries:
+                break
+            continue
+        known_run = 0
+        try:
+            ne = normalise_entry(e, keep_raw=keep_raw)
+            entries.append(ne)
+            if max_entries and len(entries) + skipped >= max_entries:
+                break
+        except Exception:
+            continue
+
+    return {"entries": entries, "skipped": skipped, "bozo": bozo, "bozo_exception": bozo_exc}
+
+def _parse_in_worker(
+    content: bytes,
+    max_entries: Optional[int] = None,
+    known: Optional[Container[str]] = None,
+    stop_after_known: Optional[int] = None,
+) -> Dict:
+    # Runs in a worker process: ship back plain entries only, never the parsed tree
+    parsed = parse_entries(content, max_entries, keep_raw=False, known=known, stop_after_known=stop_after_known)
+    exc = parsed["bozo_exception"]
+    if exc is not None:
+        try:
+            pickle.dumps(exc)
+        except Exception:
+            parsed["bozo_exception"] = RuntimeError(f"{type(exc).__name__}: {exc}")
+    return parsed
 
 def fetch_feed(
     url: str,
     timeout: int = 10,
     etag: Optional[str] = None,
-    modified: Optional[float] = None,
+    modified: Optional[str] = None,
     max_entries: Optional[int] = None,
+    parse_executor: Optional[Executor] = None,
+    keep_raw: bool = False,
+    known: Optional[Container[str]] = None,
+    stop_after_known: Optional[int] = None,
 ) -> Dict:
+    if keep_raw and parse_executor is not None:
+        # Raw feedparser entries stay in the worker process; only plain entries come back
+        raise ValueError("keep_raw needs in-process parsing; it cannot be combined with parse_executor")
     headers: Dict[str, Any] = {"User-Agent": USER_AGENT}
     if etag:
         headers["If-None-Match"] = etag
@@ -75,27 +166,90 @@ def fetch_feed(
         }
 
     content = resp.content or b""
-    d = feedparser.parse(content)
-
-    bozo = getattr(d, "bozo", False)
-    bozo_exc = getattr(d, "bozo_exception", None)
-
-    entries_raw = getattr(d, "entries", []) or d.get("entries", [])
-    entries: List[Dict] = []
-    for e in entries_raw:
-        try:
-            ne = normalise_entry(e)
-            entries.append(ne)
-            if max_entries and len(entries) >= max_entries:
-                break
-        except Exception:
-            continue
+    if parse_executor is not None:
+        parsed = parse_executor.submit(_parse_in_worker, content, max_entries, known, stop_after_known).result()
+    else:
+        parsed = parse_entries(content, max_entries, keep_raw=keep_raw, known=known, stop_after_known=stop_after_known)
+    entries = parsed["entries"]
+    bozo = parsed["bozo"]
+    bozo_exc = parsed["bozo_exception"]
 
     return {
         "entries": entries,
+        "skipped": parsed["skipped"],
         "status": status,
         "etag": returned_etag,
         "modified": returned_modified,
         "bozo": bozo,
         "bozo_exception": bozo_exc,
-    }
\ No newline at end of file
+    }
+
+def _host_of(url: str) -> str:
+    try:
+        return (urlparse(url).netloc or url).lower()
+    except Exception:
+        return url
+
+def fetch_feeds(
+    jobs: List[Dict],
+    max_workers: int = 16,
+    per_host: int = 2,
+    timeout: int = 10,
+    max_entries: Optional[int] = None,
+    parse_executor: Optional[Executor] = None,
+    keep_raw: bool = False,
+) -> List[Dict]:
+    # Jobs may also carry "known" / "stop_after_known" (see parse_entries).
+    # Results come back in the same order as `jobs`, each tagged with its url and
+    # the seconds spent on it (including any wait for a per-host slot)
+    if not jobs:
+        return []
+    if keep_raw and parse_executor is not None:
+        raise ValueError("keep_raw needs in-process parsing; it cannot be combined with parse_executor")
+
+    host_locks: Dict[str, threading.Semaphore] = {}
+    host_locks_guard = threading.Lock()
+
+    def _host_slot(url: str) -> threading.Semaphore:
+        host = _host_of(url)
+        with host_locks_guard:
+            sem = host_locks.get(host)
+            if sem is None:
+                sem = threading.Semaphore(max(1, per_host))
+                host_locks[host] = sem
+            return sem
+
+    def _run(job: Dict) -> Dict:
+        url = job.get("url")
+        started = time.perf_counter()
+        with _host_slot(url):
+            try:
+                result = fetch_feed(
+                    url,
+                    timeout=timeout,
+                    etag=job.get("etag"),
+                    modified=job.get("modified"),
+                    max_entries=max_entries,
+                    parse_executor=parse_executor,
+                    keep_raw=keep_raw,
+                    known=job.get("known"),
+                    stop_after_known=job.get("stop_after_known"),
+                )
+            except Exception as exc:
+                result = {
+                    "entries": [],
+                    "status": None,
+                    "etag": None,
+                    "modified": None,
+                    "bozo": True,
+                    "bozo_exception": exc,
+                }
+        result["url"] = url
+        result["elapsed"] = time.perf_counter() - started
+        return result
+
+    workers = max(1, min(max_workers, len(jobs)))
+    if workers == 1:
+        return [_run(j) for j in jobs]
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fetch") as pool:
+        return list(pool.map(_run, jobs))
@@ -0,0 +1,177 @@
+## Runs long admin tasks (e.g. a full digest run) in the background and tracks their progress.
+## Job state lives in Postgres so every web worker can report on a job started by another.
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, UTC
+import logging
+import threading
+import uuid
+from psycopg2.extras import RealDictCursor, Json
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import db
+
+logger = logging.getLogger(__name__)
+
+# An active job not updated for this long belongs to a worker that died mid-run
+STALE_JOB = "15 minutes"
+# Finished jobs are kept for the status endpoint until this many newer ones exist
+MAX_JOBS = 50
+
+Progress = Callable[[str, Dict[str, Any]], None]
+
+@dataclass
+class Job:
+    id: str
+    name: str
+    status: str = "queued"  # queued, running, succeeded, failed
+    stage: Optional[str] = None
+    stages: List[Dict[str, Any]] = field(default_factory=list)
+    created_at: datetime = field(default_factory=lambda: datetime.now(UTC))
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    result: Any = None
+    error: Optional[str] = None
+
+def _iso(dt: Optional[datetime]) -> Optional[str]:
+    return dt.isoformat() if dt else None
+
+def _stages_json(stages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    return [dict(s, started_at=_iso(s["started_at"]), finished_at=_iso(s["finished_at"])) for s in stages]
+
+def _row_dict(row: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "id": row["id"],
+        "name": row["name"],
+        "status": row["status"],
+        "stage": row["stage"],
+        "stages": row["stages"] or [],
+        "created_at": _iso(row["created_at"]),
+        "started_at": _iso(row["started_at"]),
+        "finished_at": _iso(row["finished_at"]),
+        "result": row["result"],
+        "error": row["error"],
+    }
+
+_table_ready = False
+_table_lock = threading.Lock()
+# One worker: jobs never overlap within a process (across processes, see start())
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="job")
+
+def _ensure_table() -> None:
+    global _table_ready
+    if _table_ready:
+        return
+    with _table_lock:
+        if _table_ready:
+            return
+        with db.connection() as conn:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        CREATE TABLE IF NOT EXISTS jobs (
+                        id TEXT PRIMARY KEY,
+                        name TEXT NOT NULL,
+                        status TEXT NOT NULL DEFAULT 'queued',
+                        stage TEXT,
+                        stages JSONB NOT NULL DEFAULT '[]',
+                        result JSONB,
+                        error TEXT,
+                        created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                        started_at TIMESTAMPTZ,
+                        finished_at TIMESTAMPTZ,
+                        updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                        );
+                        CREATE UNIQUE INDEX IF NOT EXISTS jobs_active_idx ON jobs ((status IN ('queued', 'running'))) WHERE status IN ('queued', 'running');
+                    """)
+        _table_ready = True
+
+def _save(job: Job) -> None:
+    with db.connection() as conn:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE jobs SET status = %s, stage = %s, stages = %s, result = %s, error = %s,
+                        started_at = %s, finished_at = %s, updated_at = now()
+                    WHERE id = %s;
+                """, (job.status, job.stage, Json(_stages_json(job.stages)), Json(job.result), job.error,
+                      job.started_at, job.finished_at, job.id))
+
+def start(name: str, fn: Callable[[Progress], Any]) -> Tuple[Dict[str, Any], bool]:
+    # Returns (job, True) for a newly queued job, or (active job, False) if one is already
+    # queued or running in any worker; the partial unique index allows only one at a time
+    _ensure_table()
+    job = Job(id=uuid.uuid4().hex[:12], name=name)
+    with db.connection() as conn:
+        with conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(f"""
+                    UPDATE jobs SET status = 'failed', error = 'Abandoned: the worker running it stopped reporting', finished_at = now()
+                    WHERE status IN ('queued', 'running') AND updated_at < now() - INTERVAL '{STALE_JOB}';
+                """)
+                cur.execute("""
+                    INSERT INTO jobs (id, name, created_at) VALUES (%s, %s, %s)
+                    ON CONFLICT ((status IN ('queued', 'running'))) WHERE status IN ('queued', 'running') DO NOTHING
+                    RETURNING *;
+                """, (job.id, job.name, job.created_at))
+                row = cur.fetchone()
+                if row is None:
+                    cur.execute("SELECT * FROM jobs WHERE status IN ('queued', 'running');")
+                    row = cur.fetchone()
+                    if row is not None:
+                        return _row_dict(row), False
+                    raise RuntimeError("could not queue job: another job finished while it was being queued")
+                cur.execute("""
+                    DELETE FROM jobs WHERE id IN (SELECT id FROM jobs ORDER BY created_at DESC OFFSET %s);
+                """, (MAX_JOBS,))
+    _executor.submit(_run, job, fn)
+    return _row_dict(row), True
+
+def get(job_id: str) -> Optional[Dict[str, Any]]:
+    _ensure_table()
+    with db.connection() as conn:
+        with conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute("SELECT * FROM jobs WHERE id = %s;", (job_id,))
+                row = cur.fetchone()
+                return _row_dict(row) if row else None
+
+def latest() -> Optional[Dict[str, Any]]:
+    _ensure_table()
+    with db.connection() as conn:
+        with conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute("SELECT * FROM jobs ORDER BY created_at DESC LIMIT 1;")
+                row = cur.fetchone()
+                return _row_dict(row) if row else None
+
+def _finish_stage(job: Job, now: datetime) -> None:
+    if job.stages and job.stages[-1]["finished_at"] is None:
+        job.stages[-1]["finished_at"] = now
+
+def _run(job: Job, fn: Callable[[Progress], Any]) -> None:
+    def progress(stage: str, info: Dict[str, Any]) -> None:
+        now = datetime.now(UTC)
+        if job.stage != stage:
+            _finish_stage(job, now)
+            job.stages.append({"name": stage, "started_at": now, "finished_at": None, "info": {}})
+            job.stage = stage
+        job.stages[-1]["info"].update(info)
+        _save(job)
+
+    job.status = "running"
+    job.started_at = datetime.now(UTC)
+    try:
+        _save(job)
+        result = fn(progress)
+    except Exception as exc:
+        logger.exception("Job %s (%s) failed: %s", job.id, job.name, exc)
+        job.status, job.result, job.error = "failed", None, str(exc)
+    else:
+        job.status, job.result = "succeeded", result
+    job.finished_at = datetime.now(UTC)
+    _finish_stage(job, job.finished_at)
+    try:
+        _save(job)
+    except Exception:
+        logger.exception("Could not record the outcome of job %s", job.id)
@@ -1,17 +1,28 @@
 ## Handles all SMTP and mailing operations
 
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from email import policy
 from email.message import EmailMessage
+from email.utils import make_msgid
 import smtplib
 import ssl
 import re
-from typing import List, Optional, Union
+import threading
+import time
+from typing import Dict, List, Optional, Union
+from urllib.parse import quote
 import config
 import logging
 
 logger = logging.getLogger(__name__)
 SMTP_TIMEOUT = 30
+# First retry delay in seconds; doubles with each further attempt
+SMTP_RETRY_BACKOFF = 1.0
 
-def _normalise_recipients(recipients: Union[str, List[str]]) -> List[str]:
+def normalise_recipients(recipients: Union[str, List[str]]) -> List[str]:
+    # A comma-separated string or a list, stripped of blanks; also used by the outbox
     if isinstance(recipients, str):
         return [r.strip() for r in recipients.split(',') if r.strip()]
     return [r.strip() for r in recipients if r and r.strip()]
@@ -42,6 +53,33 @@ def _build_message(from_addr: str, to_addr: str, subject: str, html_body: str, t
     msg.add_alternative(html_body, subtype="html")
     return msg
 
+def _header(name: str, value: str) -> bytes:
+    # Parsed first so non-ASCII display names get RFC 2047 encoded like in a built message
+    return policy.SMTP.fold_binary(*policy.SMTP.header_store_parse(name, value))
+
+class _MessageTemplate:
+    # Serialises the multipart body once; each recipient then only costs a few folded headers
+    # spliced in front of the shared bytes
+    def __init__(self, from_addr: str, subject: str, html_body: str, text_body: str, reply_to: Optional[str]):
+        msg = _build_message(from_addr=from_addr, to_addr="", subject=subject, html_body=html_body, text_body=text_body, reply_to=reply_to)
+        del msg["To"]
+        raw = msg.as_bytes(policy=policy.SMTP)
+        head, _, body = raw.partition(b"\r\n\r\n")
+        self.head = head + b"\r\n"
+        self.body = b"\r\n" + body
+        self.domain = from_addr.rpartition("@")[2] or None
+        self.unsubscribe = getattr(config, "LIST_UNSUBSCRIBE", None)
+
+    def render(self, to_addr: str, recipient: Optional[str] = None) -> bytes:
+        headers = [
+            _header("To", to_addr),
+            _header("Message-ID", make_msgid(domain=self.domain)),
+        ]
+        if self.unsubscribe and recipient:
+            link = self.unsubscribe.replace("{email}", quote(recipient, safe="@"))
+            headers.append(_header("List-Unsubscribe", f"<{link}>"))
+        return self.head + b"".join(headers) + self.body
+
 def html_to_text(html: str) -> str:
     html = re.sub(r"(?is)<(script|style).*?>.*?</\1>", "", html)
     html = re.sub(r"(?i)<br\s*/?>", "\n", html)
@@ -59,6 +97,194 @@ def _create_ssl_context(skip_verify: bool) -> ssl.SSLContext:
         return ctx
     return ssl.create_default_context()
 
+def _open_smtp() -> smtplib.SMTP:
+    smtp_server = getattr(config, "SMTP_SERVER", "smtp.gmail.com")
+    smtp_port = int(getattr(config, "SMTP_PORT", 587))
+    skip_auth = getattr(config, "SKIP_SMTP_AUTH", False)
+    smtp_login_user = getattr(config, "SMTP_USERNAME", None) or config.EMAIL_FROM
+
+    context = _create_ssl_context(getattr(config, "SKIP_TLS_VERIFY", False))
+    if smtp_port == 465:
+        server = smtplib.SMTP_SSL(smtp_server, smtp_port, timeout=SMTP_TIMEOUT, context=context)
+        if not skip_auth:
+            if not getattr(config, "EMAIL_PASSWORD", None):
+                raise RuntimeError("EMAIL_PASSWORD required for SMTP authentication")
+            server.login(smtp_login_user, config.EMAIL_PASSWORD)
+        return server
+    else:
+        server = smtplib.SMTP(smtp_server, smtp_port, timeout=SMTP_TIMEOUT)
+        server.ehlo()
+        try:
+            server.starttls(context=ssl.create_default_context())
+            server.ehlo()
+        except smtplib.SMTPException:
+            if config.DEBUG:
+                logger.debug("STARTTLS failed or unsupported; continuing without STARTTLS")
+        if not skip_auth:
+            if not getattr(config, "EMAIL_PASSWORD", None):
+                raise RuntimeError("EMAIL_PASSWORD required for SMTP authentication")
+            server.login(smtp_login_user, config.EMAIL_PASSWORD)
+        return server
+
+def _close_smtp(server: smtplib.SMTP) -> None:
+    try:
+        server.quit()
+    except Exception:
+        try:
+            server.close()
+        except Exception:
+            pass
+
+@dataclass
+class _Session:
+    server: smtplib.SMTP
+    sent: int = 0
+
+class SmtpPool:
+    # Up to `size` authenticated sessions shared between delivery threads. Sessions are
+    # opened lazily, dropped when they break, and rotated after `max_messages` sends.
+    def __init__(self, size: int, max_messages: Optional[int] = None):
+        self.size = max(1, size)
+        self.max_messages = max_messages
+        self._slots = threading.BoundedSemaphore(self.size)
+        self._idle: List[_Session] = []
+        self._lock = threading.Lock()
+        self.opened = 0
+
+    @contextmanager
+    def session(self):
+        self._slots.acquire()
+        sess = None
+        try:
+            with self._lock:
+                sess = self._idle.pop() if self._idle else None
+            if sess is None:
+                sess = _Session(_open_smtp())
+                with self._lock:
+                    self.opened += 1
+            yield sess
+        except BaseException:
+            # Whatever went wrong, the session may be half way through a transaction
+            if sess is not None:
+                _close_smtp(sess.server)
+            raise
+        else:
+            if self.max_messages and sess.sent >= self.max_messages:
+                _close_smtp(sess.server)
+            else:
+                with self._lock:
+                    self._idle.append(sess)
+        finally:
+            self._slots.release()
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for sess in idle:
+            _close_smtp(sess.server)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class BccSendError(RuntimeError):
+    # Raised when no BCC chunk was delivered; carries the per-recipient results regardless
+    def __init__(self, message: str, results: List[Dict]):
+        super().__init__(message)
+        self.results = results
+
+def _is_transient(exc: Exception) -> bool:
+    # Disconnects, network errors and 4xx replies are worth retrying on a fresh connection
+    if isinstance(exc, smtplib.SMTPServerDisconnected):
+        return True
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in exc.recipients.values())
+    if isinstance(exc, smtplib.SMTPResponseException):
+        return 400 <= exc.smtp_code < 500
+    # SMTPException subclasses OSError, so only plain socket errors get this far
+    return isinstance(exc, OSError) and not isinstance(exc, smtplib.SMTPException)
+
+def _error_code(exc: Exception) -> Optional[int]:
+    if isinstance(exc, smtplib.SMTPResponseException):
+        return exc.smtp_code
+    if isinstance(exc, smtplib.SMTPRecipientsRefused) and exc.recipients:
+        return next(iter(exc.recipients.values()))[0]
+    return None
+
+def _deliver(pool: SmtpPool, from_addr: str, payload: bytes, to_addrs: List[str], max_retries: int) -> Dict:
+    started = time.perf_counter()
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            with pool.session() as sess:
+                refused = sess.server.sendmail(from_addr, to_addrs, payload)
+                sess.sent += 1
+            # Recipients the server turned down while still accepting the message for the rest
+            return {"ok": True, "error": None, "code": None, "transient": False, "recipient_refused": False, "attempts": attempt,
+                    "latency_ms": round((time.perf_counter() - started) * 1000, 1), "refused": refused or {}}
+        except Exception as exc:
+            if attempt <= max_retries and _is_transient(exc):
+                logger.debug("Transient SMTP failure for %s (attempt %d): %s", _mask_recipients(to_addrs), attempt, exc)
+                time.sleep(min(SMTP_RETRY_BACKOFF * 2 ** (attempt - 1), 30))
+                continue
+            # recipient_refused tells the server's verdict on an address apart from a failed
+            # connection, login or MAIL FROM, which says nothing about the recipients themselves
+            result = {"ok": False, "error": str(exc), "code": _error_code(exc), "transient": _is_transient(exc),
+                      "recipient_refused": isinstance(exc, smtplib.SMTPRecipientsRefused), "attempts": attempt,
+                      "latency_ms": round((time.perf_counter() - started) * 1000, 1)}
+            if isinstance(exc, smtplib.SMTPRecipientsRefused):
+                result["refused"] = exc.recipients
+            return result
+
+def _chunked(items: List[str], size: int) -> List[List[str]]:
+    size = max(1, size)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+def _split_refused(result: Dict, chunk: List[str]) -> List[Dict]:
+    # One result for the accepted recipients and one per refused recipient, so callers
+    # (e.g. the outbox) get an outcome for every address in the envelope
+    refused = result.pop("refused", None) or {}
+    result["recipients"] = [r for r in chunk if r not in refused]
+    out = [result] if result["recipients"] else []
+    for rcpt, (code, reply) in refused.items():
+        out.append({"ok": False, "error": reply.decode("utf-8", "replace") if isinstance(reply, bytes) else str(reply),
+                    "code": code, "transient": 400 <= code < 500, "recipient_refused": True, "attempts": result["attempts"],
+                    "latency_ms": result["latency_ms"], "recipients": [rcpt]})
+    return out
+
+# "Too many recipients": the same envelope split in two may well go through
+_TOO_MANY_RECIPIENTS = 452
+
+def _send_bcc_chunk(pool: SmtpPool, from_addr: str, payload: bytes, chunk: List[str], max_retries: int) -> List[Dict]:
+    result = _deliver(pool, from_addr, payload, chunk, max_retries)
+    if result["ok"] or result.get("refused"):
+        # Every refused address comes with its own reply, so no bisecting is needed
+        return _split_refused(result, chunk)
+    if len(chunk) == 1 or result["code"] != _TOO_MANY_RECIPIENTS:
+        # Message-level rejections (size, content, policy) and connection problems would fail
+        # the same way for every half, so the whole chunk shares this result
+        result["recipients"] = chunk
+        return [result]
+    logger.debug("BCC chunk of %d refused as too many recipients (%s); bisecting", len(chunk), result["error"])
+    mid = len(chunk) // 2
+    return (_send_bcc_chunk(pool, from_addr, payload, chunk[:mid], max_retries)
+            + _send_bcc_chunk(pool, from_addr, payload, chunk[mid:], max_retries))
+
+def _log_results(results: List[Dict]) -> None:
+    if not results:
+        return
+    latencies = sorted(r["latency_ms"] for r in results)
+    failed = [r for r in results if not r["ok"]]
+    logger.info(
+        "Delivered %d/%d messages (latency p50 %.0f ms, max %.0f ms)",
+        len(results) - len(failed), len(results), latencies[len(latencies) // 2], latencies[-1],
+    )
+    for r in failed:
+        logger.error("Failed sending to %s: %s", ", ".join(_mask_recipients(r["recipients"])), r["error"])
+
 def send_digest(
     recipients: Union[str, List[str]],
     subject: str,
@@ -66,8 +292,10 @@ def send_digest(
     text_body: Optional[str] = None,
     reply_to: Optional[str] = None,
     send_individually: bool = True,
-) -> None:
-    rcpts = _normalise_recipients(recipients)
+    pool_size: Optional[int] = None,
+) -> List[Dict]:
+    # Returns one result per message sent: recipients, ok, error, code, transient, recipient_refused, attempts, latency_ms
+    rcpts = normalise_recipients(recipients)
     if not rcpts:
         raise ValueError("send_digest(): No recipients provided")
 
@@ -86,77 +314,64 @@ def send_digest(
 
     if getattr(config, "DRY_RUN", False):
         logger.info("DRY_RUN enabled: composing email but not sending. Recipients (masked): %s", ", ".join(_mask_recipients(rcpts)))
-        return
+        return []
 
     if not text_body:
         text_body = html_to_text(html_body)
 
-    smtp_server = getattr(config, "SMTP_SERVER", "smtp.gmail.com")
-    smtp_port = int(getattr(config, "SMTP_PORT", 587))
-    skip_auth = getattr(config, "SKIP_SMTP_AUTH", False)
-    skip_tls_verify = getattr(config, "SKIP_TLS_VERIFY", False)
-    smtp_login_user = getattr(config, "SMTP_USERNAME", None) or from_addr
-
-    if skip_tls_verify:
+    if getattr(config, "SKIP_TLS_VERIFY", False):
         logger.warning("SKIP_TLS_VERIFY is enabled: TLS certificate verification will be disabled (INSECURE; testing only)")
 
     masked = _mask_recipients(rcpts)
     if config.DEBUG:
         logger.info("Preparing to send digest to %d recipients: %s", len(rcpts), ", ".join(masked))
 
-    def _open_smtp():
-        context = _create_ssl_context(skip_tls_verify)
-        if smtp_port == 465:
-            server = smtplib.SMTP_SSL(smtp_server, smtp_port, timeout=SMTP_TIMEOUT, context=context)
-            if not skip_auth:
-                if not getattr(config, "EMAIL_PASSWORD", None):
-                    raise RuntimeError("EMAIL_PASSWORD required for SMTP authentication")
-                server.login(smtp_login_user, config.EMAIL_PASSWORD)
-            return server
-        else:
-            server = smtplib.SMTP(smtp_server, smtp_port, timeout=SMTP_TIMEOUT)
-            server.ehlo()
-            try:
-                server.starttls(context=ssl.create_default_context())
-                server.ehlo()
-            except smtplib.SMTPException:
-                if config.DEBUG:
-                    logger.debug("STARTTLS failed or unsupported; continuing without STARTTLS")
-            if not skip_auth:
-                if not getattr(config, "EMAIL_PASSWORD", None):
-                    raise RuntimeError("EMAIL_PASSWORD required for SMTP authentication")
-                server.login(smtp_login_user, config.EMAIL_PASSWORD)
-            return server
-
-    server = None
-    try:
-        server = _open_smtp()
+    max_retries = getattr(config, "SMTP_MAX_RETRIES", 3)
+    if pool_size is None:
+        pool_size = getattr(config, "SMTP_POOL_SIZE", 4)
+    chunks = [] if send_individually else _chunked(rcpts, getattr(config, "SMTP_BCC_BATCH_SIZE", 50))
+    workers = max(1, min(pool_size, len(rcpts) if send_individually else len(chunks)))
+
+    template = _MessageTemplate(from_addr, subject, html_body, text_body, reply_to)
+
+    def _send_to(r: str) -> Dict:
+        result = _deliver(pool, from_addr, template.render(r, recipient=r), [r], max_retries)
+        result.pop("refused", None)
+        result["recipients"] = [r]
+        return result
+
+    with SmtpPool(workers, getattr(config, "SMTP_MESSAGES_PER_CONNECTION", 100)) as pool:
+        # Open the first session up front so a bad server or credentials fail the whole send, as before
+        with pool.session():
+            pass
 
         if send_individually:
-            sent_count = 0
-            for r in rcpts:
-                msg = _build_message(from_addr=from_addr, to_addr=r, subject=subject, html_body=html_body, text_body=text_body, reply_to=reply_to)
-                try:
-                    server.send_message(msg, to_addrs=[r])
-                    sent_count += 1
-                except Exception as exc:
-                    logger.error("Failed sending to %s: %s", r, exc)
+            if workers == 1:
+                results = [_send_to(r) for r in rcpts]
+            else:
+                with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="smtp") as executor:
+                    results = list(executor.map(_send_to, rcpts))
+            _log_results(results)
             if config.DEBUG:
-                logger.info("Sent %d individual messages", sent_count)
-            return
+                logger.info("Sent %d individual messages over %d connection(s)", sum(r["ok"] for r in results), pool.opened)
+            return results
         else:
             generic_to = from_addr
-            msg = _build_message(from_addr=from_addr, to_addr=generic_to, subject=subject, html_body=html_body, text_body=text_body, reply_to=reply_to)
-            try:
-                server.send_message(msg, to_addrs=rcpts)
-                if config.DEBUG:
-                    logger.info("Sent one message with %d BCC recipients", len(rcpts))
-            except Exception as exc:
-                logger.error("Failed sending BCC message: %s", exc)
-                raise
-    finally:
-        if server:
-            try:
-                server.quit()
-            except Exception:
-                pass
\ No newline at end of file
+            payload = template.render(generic_to)
+
+            def _send_chunk(chunk: List[str]) -> List[Dict]:
+                return _send_bcc_chunk(pool, from_addr, payload, chunk, max_retries)
+
+            if workers == 1:
+                per_chunk = [_send_chunk(c) for c in chunks]
+            else:
+                with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="smtp") as executor:
+                    per_chunk = list(executor.map(_send_chunk, chunks))
+            results = [r for chunk_results in per_chunk for r in chunk_results]
+            _log_results(results)
+            if not any(r["ok"] for r in results):
+                logger.error("Failed sending BCC message: %s", results[0]["error"])
+                raise BccSendError(f"BCC send failed: {results[0]['error']}", results)
+            if config.DEBUG:
+                logger.info("Sent %d BCC batches of up to %d recipients", len(chunks), len(chunks[0]))
+            return results
@@ -1,12 +1,16 @@
+import asyncio
+from contextlib import ExitStack
 import logging
 import sys
-from typing import List, Dict, Any
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 import config
 import db
 import rss_manager
 import composer
+import drafts
 import mailer
+import outbox
 import recipients
 import storage
 
@@ -14,57 +18,254 @@ logger = logging.getLogger("rss_digest")
 logging.basicConfig(level=logging.DEBUG if getattr(config, "DEBUG", False) else logging.INFO,
                     format="%(asctime)s %(levelname)s %(name)s: %(message)s")
 
-def _mark_articles_sent(articles: List[Dict[str, Any]]) -> None:
+def _mark_articles_sent(articles: List[Dict[str, Any]]) -> int:
     if not articles:
+        return 0
+    ids = [a["id"] for a in articles if a.get("id") is not None]
+    pairs = [(a.get("feed_id"), a.get("link")) for a in articles if a.get("id") is None]
+    updated = db.mark_articles_sent(ids)
+    if pairs:
+        updated += db.mark_articles_sent_by_link(pairs)
+    return updated
+
+# Exit codes for the stages that can fail; also used as job error messages by the web app
+EXIT_MESSAGES = {
+    2: "Failed to initialize DB",
+    3: "Fetching feeds failed",
+    4: "Sending the digest failed",
+    5: "Failed to mark articles as sent",
+    6: "Failed to compose digest",
+    7: "Another run is already in progress",
+}
+
+Progress = Callable[[str, Dict[str, Any]], None]
+
+def _report(progress: Optional[Progress], stage: str, **info: Any) -> None:
+    # Progress is informational only; a broken callback must never fail a run
+    if progress is None:
         return
-    conn = db.get_connection()
     try:
-        with conn:
-            with conn.cursor() as cur:
-                for a in articles:
-                    link = a.get("link")
-                    feed_id = a.get("feed_id")
-                    cur.execute(
-                        "UPDATE articles SET sent = TRUE WHERE link = %s AND (feed_id IS NOT DISTINCT FROM %s)",
-                        (link, feed_id),
-                    )
-    finally:
-        conn.close()
-
-def main() -> int:
-    logger.info("Starting rss-digest runner")
+        progress(stage, info)
+    except Exception:
+        logger.debug("Progress callback failed", exc_info=True)
 
+def _use_drafts(ingest_only: bool = False) -> bool:
+    if ingest_only or getattr(config, "INCREMENTAL_DIGEST", False):
+        return True
+    # A draft left by an --ingest run (or from before INCREMENTAL_DIGEST was turned off) must
+    # still be sent: its articles are already stored, so no run would return them as new again
     try:
-        db.init_db()
+        drafts.ensure_table()
+        return drafts.has_open_draft()
     except Exception as exc:
-        logger.exception("Failed to initialize DB: %s", exc)
-        return 2
+        logger.warning("Could not check for an open digest draft: %s", exc)
+        return False
 
+def _add_to_draft(new_items: List[Dict[str, Any]], progress: Optional[Progress] = None) -> int:
+    _report(progress, "draft", items=len(new_items))
     try:
-        new_items = rss_manager.run_once(max_entries_per_feed=getattr(config, "MAX_ENTRIES_PER_FEED", None))
+        drafts.ensure_table()
+        drafts.append(new_items, max_items=getattr(config, "MAX_ITEMS", None))
     except Exception as exc:
-        logger.exception("rss_manager run failed: %s", exc)
-        return 3
+        logger.exception("Failed to add articles to the digest draft: %s", exc)
+        return 6
+    return 0
 
-    if not new_items:
-        logger.info("No new articles found. Nothing to send.")
-        return 0
+def main(progress: Optional[Progress] = None, ingest_only: bool = False, wait_for_lock: bool = True) -> int:
+    # ingest_only fetches and adds new articles to the digest draft without sending anything.
+    # wait_for_lock=False gives up at once if another run is in progress (the admin button).
+    logger.info("Starting rss-digest runner%s", " (ingest only)" if ingest_only else "")
 
-    logger.info("Found %d new articles; composing digest", len(new_items))
+    with ExitStack() as stack:
+        _report(progress, "init")
+        try:
+            db.init_db()
+            # Cron and the admin "run now" button share this lock, so two runs never overlap
+            wait = getattr(config, "RUN_LOCK_WAIT", 1800) if wait_for_lock else 0
+            acquired = stack.enter_context(db.run_lock(wait))
+        except Exception as exc:
+            logger.exception("Failed to initialize DB: %s", exc)
+            return 2
+        if not acquired:
+            logger.warning("Another digest run is still in progress; exiting")
+            return 7
 
-    max_items = getattr(config, "MAX_ITEMS", None)
+        _report(progress, "fetch")
+        try:
+            new_items = rss_manager.run_once(max_entries_per_feed=getattr(config, "MAX_ENTRIES_PER_FEED", None))
+        except Exception as exc:
+            logger.exception("rss_manager run failed: %s", exc)
+            return 3
+        _report(progress, "fetch", new_items=len(new_items))
+
+        use_drafts = _use_drafts(ingest_only)
+        if use_drafts:
+            code = _add_to_draft(new_items, progress)
+            if code or ingest_only:
+                return code
+        return _deliver(new_items, progress, use_drafts)
+
+async def main_async(ingest_only: bool = False) -> int:
+    # Same stages and exit codes as main(); fetching and ingestion overlap across feeds
+    logger.info("Starting rss-digest runner (async pipeline)%s", " (ingest only)" if ingest_only else "")
+
+    with ExitStack() as stack:
+        try:
+            await asyncio.to_thread(db.init_db)
+            acquired = await asyncio.to_thread(stack.enter_context, db.run_lock(getattr(config, "RUN_LOCK_WAIT", 1800)))
+        except Exception as exc:
+            logger.exception("Failed to initialize DB: %s", exc)
+            return 2
+        if not acquired:
+            logger.warning("Another digest run is still in progress; exiting")
+            return 7
+
+        try:
+            new_items = await rss_manager.run_once_async(max_entries_per_feed=getattr(config, "MAX_ENTRIES_PER_FEED", None))
+        except Exception as exc:
+            logger.exception("rss_manager run failed: %s", exc)
+            return 3
+
+        use_drafts = await asyncio.to_thread(_use_drafts, ingest_only)
+        if use_drafts:
+            code = await asyncio.to_thread(_add_to_draft, new_items)
+            if code or ingest_only:
+                return code
+        return await asyncio.to_thread(_deliver, new_items, None, use_drafts)
+
+def _compose_streaming(new_items: List[Dict[str, Any]], max_items: Optional[int]) -> Optional[Tuple[str, str, str, str]]:
+    # Renders the HTML straight into the digest file, then reads it back: the mailer and the
+    # outbox need it as one string, so this lowers memory while rendering, not while sending.
+    # Returns None so the caller can fall back to compose_digest().
     try:
-        subject, html_body, text_body = composer.compose_digest(new_items, max_items=max_items)
+        subject, html_chunks, text_chunks = composer.compose_digest_stream(new_items, max_items=max_items)
+        filename = storage.write_digest_html_stream(subject, html_chunks, len(new_items))
+        logger.info("Streamed digest HTML to digests/%s", filename)
+        text_body = "".join(text_chunks).strip()
+        html_body = storage.read_digest_html(filename)
     except Exception as exc:
-        logger.exception("Failed to compose digest: %s", exc)
-        return 6
+        logger.exception("Streaming compose failed; falling back to in-memory compose: %s", exc)
+        return None
+    return subject, html_body, text_body, filename
 
+def _trial_run() -> bool:
+    return bool(getattr(config, "DRY_RUN", False) or getattr(config, "TEST_EMAIL", None))
+
+def _use_outbox() -> bool:
+    # Test and dry runs must not leave queued deliveries behind for the next real run
+    if _trial_run():
+        return False
+    return getattr(config, "OUTBOX", True) and bool(getattr(config, "DB_URL", None))
+
+def _finish_digest(digest_id: int, state: Dict[str, Any], articles: List[Dict[str, Any]]) -> int:
+    logger.info(
+        "Digest %d: %d sent, %d failed, %d pending",
+        digest_id, state.get("sent", 0), state.get("failed", 0), state.get("pending", 0) + state.get("sending", 0),
+    )
+    if not state["complete"]:
+        logger.warning("Digest %d still has deliveries awaiting retry; they will be resumed on the next run", digest_id)
+        return 0
+    if not state["delivered"]:
+        # Every delivery failed for good, so the articles were never mailed to anyone
+        logger.error("Digest %d reached none of its recipients; its articles stay unsent", digest_id)
+        return 4
     try:
-        filename = storage.write_digest_html(subject, html_body, len(new_items))
-        logger.info("Wrote digest HTML to digests/%s", filename)
+        updated = _mark_articles_sent(articles)
+        logger.info("Marked %d articles as sent in DB", updated)
     except Exception as exc:
-        logger.exception("Failed to write digest HTML file: %s", exc)
-        filename = None
+        logger.exception("Failed to mark articles as sent: %s", exc)
+        return 5
+    return 0
+
+def _sent_counter(progress: Optional[Progress], stage: str) -> Callable[[List[Dict[str, Any]]], None]:
+    # Accumulates per-batch send results into running totals for the progress callback
+    totals = {"sent": 0, "failed": 0}
+    def on_batch(results: List[Dict[str, Any]]) -> None:
+        for r in results:
+            n = len(r.get("recipients") or [])
+            totals["sent" if r["ok"] else "failed"] += n
+        _report(progress, stage, **totals)
+    return on_batch
+
+def _resume_outbox(progress: Optional[Progress] = None) -> int:
+    try:
+        outbox.ensure_table()
+        pending = outbox.unfinished_digests()
+    except Exception as exc:
+        logger.exception("Failed to read the outbox: %s", exc)
+        return 4
+    if pending:
+        _report(progress, "resume", digests=len(pending))
+    # One digest failing must not keep the others waiting; the first error is returned
+    result = 0
+    for digest_id in pending:
+        logger.info("Resuming unfinished digest %d", digest_id)
+        try:
+            state = outbox.drain(digest_id, on_batch=_sent_counter(progress, "resume"))
+        except Exception as exc:
+            logger.exception("Failed to resume digest %d: %s", digest_id, exc)
+            result = result or 4
+            continue
+        code = _finish_digest(digest_id, state, outbox.get_digest(digest_id)["articles"])
+        result = result or code
+    return result
+
+def _deliver(new_items: List[Dict[str, Any]], progress: Optional[Progress] = None, use_drafts: bool = False) -> int:
+    # A failed resume is reported only after this run's digest has been queued: its articles
+    # are already stored, so no later run would return them as new
+    resumed = _resume_outbox(progress) if _use_outbox() else 0
+    if resumed:
+        logger.warning("Resuming earlier digests failed (exit code %d); sending this run's digest anyway", resumed)
+    return _send_new(new_items, progress, use_drafts) or resumed
+
+def _send_new(new_items: List[Dict[str, Any]], progress: Optional[Progress], use_drafts: bool) -> int:
+
+    # With a draft, the digest covers everything ingested since the last send, not just this run
+    draft = None
+    if use_drafts:
+        try:
+            draft = drafts.load_draft()
+        except Exception as exc:
+            logger.exception("Failed to load the digest draft: %s", exc)
+            return 6
+        new_items = draft["articles"] if draft else []
+
+    if not new_items:
+        logger.info("No new articles found. Nothing to send.")
+        return 0
+
+    if draft is not None:
+        logger.info("Finalising digest draft %d (%d articles)", draft["id"], len(new_items))
+    else:
+        logger.info("Found %d new articles; composing digest", len(new_items))
+    _report(progress, "compose", items=len(new_items))
+
+    max_items = getattr(config, "MAX_ITEMS", None)
+    composed = None
+    if draft is None and getattr(config, "STREAM_COMPOSE", False):
+        composed = _compose_streaming(new_items, max_items)
+
+    if composed is None:
+        try:
+            if draft is not None:
+                subject, html_body, text_body = composer.compose_draft(draft)
+            else:
+                subject, html_body, text_body = composer.compose_digest(new_items, max_items=max_items)
+        except Exception as exc:
+            logger.exception("Failed to compose digest: %s", exc)
+            return 6
+
+        _report(progress, "store")
+        try:
+            # Articles past MAX_ITEMS are in a draft's article list but were never rendered
+            item_count = len(draft["items"]) if draft is not None else len(new_items)
+            filename = storage.write_digest_html(subject, html_body, item_count)
+            logger.info("Wrote digest HTML to digests/%s", filename)
+        except Exception as exc:
+            logger.exception("Failed to write digest HTML file: %s", exc)
+            filename = None
+    else:
+        subject, html_body, text_body, filename = composed
 
     try:
         recips = recipients.get_recipients() or getattr(config, "EMAIL_TO", [])
@@ -76,34 +277,70 @@ def main() -> int:
         logger.warning("No recipients configured; digest created but not sent")
         return 0
 
+    send_individual = getattr(config, "SEND_INDIVIDUALLY", False)
+    _report(progress, "send", recipients=len(recips), sent=0, failed=0)
+    if _use_outbox():
+        try:
+            digest_id = outbox.enqueue(subject, html_body, text_body, recips, new_items,
+                                       send_individually=send_individual, filename=filename,
+                                       draft_id=draft["id"] if draft else None)
+        except Exception as exc:
+            logger.exception("Failed to queue digest: %s", exc)
+            return 4
+        try:
+            state = outbox.drain(digest_id, on_batch=_sent_counter(progress, "send"))
+        except Exception as exc:
+            logger.exception("Failed to send digest %d; unsent deliveries stay queued: %s", digest_id, exc)
+            return 4
+        _report(progress, "mark")
+        code = _finish_digest(digest_id, state, new_items)
+        if code == 0:
+            _report(progress, "done", complete=state["complete"])
+            logger.info("Run complete (db pool: %s)", db.pool_stats())
+        return code
+
     try:
-        send_individual = getattr(config, "SEND_INDIVIDUALLY", False)
-        mailer.send_digest(
+        results = mailer.send_digest(
             recipients=recips,
             subject=subject,
             html_body=html_body,
             text_body=text_body,
             send_individually=send_individual,
         )
+        failed = sum(1 for r in results if not r["ok"])
+        _sent_counter(progress, "send")(results)
         logger.info(
-            "Digest sent successfully to %d recipients (mode: %s); cached file: %s",
-            len(recips),
+            "Digest sent successfully to %d recipients (mode: %s, failed: %d); cached file: %s",
+            len(recips) - failed if results else len(recips),
             "individual" if send_individual else "bcc",
+            failed,
             filename or "<none>",
             )
     except Exception as exc:
         logger.exception("Failed to send digest: %s", exc)
         return 4
 
+    if draft is not None and not _trial_run():
+        try:
+            drafts.close(draft["id"], filename)
+        except Exception as exc:
+            logger.exception("Failed to close digest draft %d; its articles would be sent again: %s", draft["id"], exc)
+            return 5
+
+    _report(progress, "mark")
     try:
-        _mark_articles_sent(new_items)
-        logger.info("Marked %d articles as sent in DB", len(new_items))
+        updated = _mark_articles_sent(new_items)
+        logger.info("Marked %d articles as sent in DB", updated)
     except Exception as exc:
         logger.exception("Failed to mark articles as sent: %s", exc)
         return 5
 
-    logger.info("Run complete")
+    _report(progress, "done")
+    logger.info("Run complete (db pool: %s)", db.pool_stats())
     return 0
 
 if __name__ == "__main__":
-    sys.exit(main())
\ No newline at end of file
+    ingest_only = "--ingest" in sys.argv[1:]
+    if "--async" in sys.argv[1:] or getattr(config, "ASYNC_PIPELINE", False):
+        sys.exit(asyncio.run(main_async(ingest_only=ingest_only)))
+    sys.exit(main(ingest_only=ingest_only))
\ No newline at end of file
@@ -0,0 +1,228 @@
+## Durable per-recipient delivery queue, so an interrupted send can resume without re-mailing anyone
+
+import os
+import logging
+from psycopg2.extras import RealDictCursor, Json, execute_values
+from typing import Any, Callable, Dict, List, Optional
+import config
+import db
+import drafts
+import mailer
+
+logger = logging.getLogger(__name__)
+
+DB_URL = getattr(config, "DB_URL", None) or os.environ.get("DB_URL")
+
+# A row left in 'sending' this long belongs to a run that died mid-batch
+STALE_CLAIM = "15 minutes"
+
+def _get_conn():
+    if not DB_URL:
+        raise RuntimeError("DB_URL not configured; cannot access outbox tables")
+    return db.connection()
+
+def ensure_table():
+    sql = """
+    CREATE TABLE IF NOT EXISTS outbox_digests (
+    id SERIAL PRIMARY KEY,
+    subject TEXT NOT NULL,
+    html_body TEXT NOT NULL,
+    text_body TEXT,
+    send_individually BOOLEAN NOT NULL DEFAULT TRUE,
+    articles JSONB NOT NULL DEFAULT '[]',
+    filename TEXT,
+    created_at TIMESTAMPTZ DEFAULT now(),
+    completed_at TIMESTAMPTZ
+    );
+    CREATE TABLE IF NOT EXISTS outbox (
+    id BIGSERIAL PRIMARY KEY,
+    digest_id INTEGER NOT NULL REFERENCES outbox_digests(id) ON DELETE CASCADE,
+    recipient TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    claimed_at TIMESTAMPTZ,
+    sent_at TIMESTAMPTZ,
+    last_code INTEGER,
+    last_error TEXT,
+    latency_ms REAL,
+    UNIQUE (digest_id, recipient)
+    );
+    CREATE INDEX IF NOT EXISTS outbox_pending_idx ON outbox (digest_id, next_attempt_at) WHERE status = 'pending';
+    DELETE FROM outbox_digests WHERE completed_at < now() - INTERVAL '90 days';
+    """
+    with _get_conn() as conn:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute(sql)
+
+def enqueue(
+    subject: str,
+    html_body: str,
+    text_body: Optional[str],
+    recipients: List[str],
+    articles: List[Dict[str, Any]],
+    send_individually: bool = True,
+    filename: Optional[str] = None,
+    draft_id: Optional[int] = None,
+) -> int:
+    # The digest and all of its deliveries are written in one transaction, which also
+    # closes the draft it was finalised from, so the draft can never be sent twice
+    rcpts = list(dict.fromkeys(mailer.normalise_recipients(recipients)))
+    refs = [{"id": a.get("id"), "feed_id": a.get("feed_id"), "link": a.get("link")} for a in articles]
+    with _get_conn() as conn:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO outbox_digests (subject, html_body, text_body, send_individually, articles, filename)
+                    VALUES (%s, %s, %s, %s, %s, %s) RETURNING id;
+                """, (subject, html_body, text_body, send_individually, Json(refs), filename))
+                digest_id = cur.fetchone()[0]
+                execute_values(cur, "INSERT INTO outbox (digest_id, recipient) VALUES %s ON CONFLICT DO NOTHING",
+                               [(digest_id, r) for r in rcpts], page_size=1000)
+                if draft_id is not None:
+                    drafts.close(draft_id, filename, cur=cur)
+    logger.info("Queued digest %d for %d recipients", digest_id, len(rcpts))
+    return digest_id
+
+def unfinished_digests() -> List[int]:
+    with _get_conn() as conn:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT id FROM outbox_digests WHERE completed_at IS NULL ORDER BY id;")
+                return [r[0] for r in cur.fetchall()]
+
+def get_digest(digest_id: int) -> Optional[Dict[str, Any]]:
+    with _get_conn() as conn:
+        with conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute("SELECT * FROM outbox_digests WHERE id = %s;", (digest_id,))
+                row = cur.fetchone()
+                return dict(row) if row else None
+
+def _claim(digest_id: int, limit: int) -> List[str]:
+    # SKIP LOCKED lets several senders drain the same digest without handing out a row twice
+    with _get_conn() as conn:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute(f"""
+                    UPDATE outbox SET status = 'pending'
+                    WHERE digest_id = %s AND status = 'sending' AND claimed_at < now() - INTERVAL '{STALE_CLAIM}';
+                """, (digest_id,))
+                if cur.rowcount:
+                    logger.warning("Requeued %d deliveries of digest %d left mid-send by an earlier run", cur.rowcount, digest_id)
+                cur.execute("""
+                    UPDATE outbox SET status = 'sending', attempts = attempts + 1, claimed_at = now()
+                    WHERE id IN (
+                        SELECT id FROM outbox
+                        WHERE digest_id = %s AND status = 'pending' AND next_attempt_at <= now()
+                        ORDER BY id LIMIT %s
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING recipient;
+                """, (digest_id, limit))
+                return [r[0] for r in cur.fetchall()]
+
+def _record(digest_id: int, results: List[Dict[str, Any]]) -> None:
+    max_attempts = getattr(config, "OUTBOX_MAX_ATTEMPTS", 5)
+    backoff = getattr(config, "OUTBOX_RETRY_BACKOFF", 60)
+    rows = []
+    for r in results:
+        if r["ok"]:
+            status = "sent"
+        elif r.get("recipient_refused") and not r.get("transient"):
+            # Only the server's permanent verdict on an address is final; anything else
+            # (login, MAIL FROM, message or connection trouble) is retried until max_attempts
+            status = "failed"
+        else:
+            status = "retry"
+        for rcpt in r["recipients"]:
+            rows.append((rcpt, status, r.get("code"), r.get("error"), r.get("latency_ms")))
+    if not rows:
+        return
+    recipients, statuses, codes, errors, latencies = (list(col) for col in zip(*rows))
+    with _get_conn() as conn:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE outbox o SET
+                        status = CASE
+                            WHEN v.status = 'retry' AND o.attempts < %(max_attempts)s THEN 'pending'
+                            WHEN v.status = 'retry' THEN 'failed'
+                            ELSE v.status END,
+                        next_attempt_at = CASE WHEN v.status = 'retry'
+                            THEN now() + make_interval(secs => %(backoff)s * 2 ^ (o.attempts - 1))
+                            ELSE o.next_attempt_at END,
+                        sent_at = CASE WHEN v.status = 'sent' THEN now() ELSE o.sent_at END,
+                        last_code = v.code,
+                        last_error = v.error,
+                        latency_ms = v.latency_ms
+                    FROM unnest(%(recipients)s::text[], %(statuses)s::text[], %(codes)s::integer[],
+                                %(errors)s::text[], %(latencies)s::real[]) AS v(recipient, status, code, error, latency_ms)
+                    WHERE o.digest_id = %(digest_id)s AND o.recipient = v.recipient AND o.status = 'sending'
+                """, {
+                    "max_attempts": int(max_attempts), "backoff": float(backoff), "digest_id": digest_id,
+                    "recipients": recipients, "statuses": statuses, "codes": codes, "errors": errors, "latencies": latencies,
+                })
+
+def _release(digest_id: int, recipients: List[str], exc: Exception) -> None:
+    # The batch failed as a whole (e.g. could not connect, log in or get MAIL FROM accepted).
+    # That says nothing about the recipients, so the batch goes back to pending with backoff
+    # and only fails for good once it runs out of attempts.
+    _record(digest_id, [{"ok": False, "transient": True, "recipients": recipients,
+                         "error": str(exc), "code": mailer._error_code(exc), "latency_ms": None}])
+
+def counts(digest_id: int) -> Dict[str, int]:
+    with _get_conn() as conn:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT status, count(*) FROM outbox WHERE digest_id = %s GROUP BY status;", (digest_id,))
+                return {status: n for status, n in cur.fetchall()}
+
+def _complete(digest_id: int) -> bool:
+    with _get_conn() as conn:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE outbox_digests SET completed_at = now()
+                    WHERE id = %s AND completed_at IS NULL
+                    AND NOT EXISTS (SELECT 1 FROM outbox WHERE digest_id = %s AND status IN ('pending', 'sending'))
+                """, (digest_id, digest_id))
+                return cur.rowcount == 1
+
+def drain(digest_id: int, batch_size: Optional[int] = None, on_batch: Optional[Callable[[List[Dict[str, Any]]], None]] = None) -> Dict[str, Any]:
+    # Sends every delivery that is currently due, passing each batch's results to on_batch.
+    # Returns the status counts, plus complete=True the first time the digest has nothing left to send
+    # and delivered=True if anyone at all received it.
+    digest = get_digest(digest_id)
+    if digest is None:
+        raise ValueError(f"drain(): no outbox digest {digest_id}")
+    if batch_size is None:
+        batch_size = getattr(config, "OUTBOX_BATCH_SIZE", 100)
+
+    while True:
+        batch = _claim(digest_id, batch_size)
+        if not batch:
+            break
+        try:
+            results = mailer.send_digest(
+                recipients=batch,
+                subject=digest["subject"],
+                html_body=digest["html_body"],
+                text_body=digest["text_body"],
+                send_individually=digest["send_individually"],
+            )
+        except mailer.BccSendError as exc:
+            _record(digest_id, exc.results)
+            raise
+        except Exception as exc:
+            _release(digest_id, batch, exc)
+            raise
+        _record(digest_id, results)
+        if on_batch is not None:
+            on_batch(results)
+
+    result: Dict[str, Any] = counts(digest_id)
+    result["complete"] = _complete(digest_id)
+    result["delivered"] = result.get("sent", 0) > 0
+    return result
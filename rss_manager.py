@@ -1,43 +1,40 @@
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
 from typing import List, Dict, Optional, Any
+import asyncio
 import logging
+import multiprocessing
+import time
 
 import feeds
 import db
 import config
+import composer
+import scheduler
 
 logger = logging.getLogger(__name__)
 
+# Per-feed timings from the most recent run_once() call
+last_fetch_timings: List[Dict] = []
+
+FEED_FIELDS = (
+    "id", "url", "category", "enabled", "added_at", "etag", "last_modified", "last_status", "last_fetched_at",
+) + scheduler.SCHEDULE_FIELDS
+
 def _row_to_feed(row: Any) -> Dict[str, Optional[Any]]:
     if row is None:
-        return {"id": None, "url": None, "category": None, "enabled": None, "added_at": None}
+        return {k: None for k in FEED_FIELDS}
 
     if isinstance(row, dict):
-        return {
-            "id": row.get("id"),
-            "url": row.get("url"),
-            "category": row.get("category"),
-            "enabled": row.get("enabled"),
-            "added_at": row.get("added_at"),
-        }
+        return {k: row.get(k) for k in FEED_FIELDS}
 
     try:
-        return {
-            "id": row[0],
-            "url": row[1],
-            "category": row[2] if len(row) > 2 else None,
-            "enabled": row[3] if len(row) > 3 else None,
-            "added_at": row[4] if len(row) > 4 else None,
-        }
+        return {k: row[i] if len(row) > i else None for i, k in enumerate(FEED_FIELDS)}
     except Exception:
-        return {"id": None, "url": None, "category": None, "enabled": None, "added_at": None}
-
-def run_once(
-    feed_urls: Optional[List[str]] = None,
-    max_entries_per_feed: Optional[int] = None,
-    persist: bool = True,
-) -> List[Dict]:
-    new_articles: List[Dict] = []
+        return {k: None for k in FEED_FIELDS}
 
+def _load_sources(feed_urls: Optional[List[str]] = None, only_due: bool = False) -> Optional[List[Dict]]:
     sources = []
     if feed_urls:
         for u in feed_urls:
@@ -53,10 +50,24 @@ def run_once(
                 else:
                     logger.info("No feeds set in DB and no FEED_URLS configured in .env")
             else:
+                now = scheduler.utc_now()
+                skipped = 0
                 for r in raw_feeds:
                     f = _row_to_feed(r)
-                    if f.get("url"):
-                        sources.append({"id": f.get("id"), "url": f.get("url")})
+                    if not f.get("url"):
+                        continue
+                    if only_due and not scheduler.is_due(f, now):
+                        skipped += 1
+                        continue
+                    sources.append({
+                        **{k: f.get(k) for k in scheduler.SCHEDULE_FIELDS},
+                        "id": f.get("id"),
+                        "url": f.get("url"),
+                        "etag": f.get("etag"),
+                        "modified": f.get("last_modified"),
+                    })
+                if skipped:
+                    logger.info("Skipping %d feeds that are not due yet", skipped)
         except Exception as exc:
             logger.exception("Failed to read feeds from DB: %s", exc)
             cfg_urls = getattr(config, "FEED_URLS", None)
@@ -64,68 +75,272 @@ def run_once(
                 for u in cfg_urls:
                     sources.append({"id": None, "url": u})
             else:
-                return []
+                return None
 
-    if not sources:
-        return []
+    return sources
 
+def _attach_known(sources: List[Dict]) -> None:
+    # Load what each feed has already stored so the fetcher can skip it before normalising
+    limit = getattr(config, "KNOWN_LINKS_PER_FEED", 500)
+    if not limit:
+        return
+    try:
+        known = db.get_known_links([s.get("id") for s in sources], per_feed_limit=limit)
+    except Exception as exc:
+        logger.warning("Failed to load known links; fetching without a filter: %s", exc)
+        return
     for src in sources:
-        feed_id = src.get("id")
-        url = src.get("url")
-        if not url:
-            continue
-        if config.DEBUG:
-            logger.info("Fetching feed %s (feed_id=%s, persist=%s)", url, feed_id, persist)
+        if src.get("id") in known:
+            src["known"] = known[src["id"]]
 
+def _record_timings(sources: List[Dict], results: List[Dict], total: float) -> None:
+    global last_fetch_timings
+    last_fetch_timings = [
+        {"feed_id": src.get("id"), "url": src.get("url"), "status": r.get("status"), "elapsed": r.get("elapsed", 0.0)}
+        for src, r in zip(sources, results)
+    ]
+    if config.DEBUG:
+        for t in last_fetch_timings:
+            logger.info("Fetched %s in %.2fs (status=%s)", t["url"], t["elapsed"], t["status"])
+    slowest = sorted(last_fetch_timings, key=lambda t: t["elapsed"], reverse=True)[:5]
+    logger.info(
+        "Fetched %d feeds in %.2fs wall time; slowest: %s",
+        len(results), total, ", ".join(f"{t['url']} ({t['elapsed']:.2f}s)" for t in slowest),
+    )
+
+def _save_fetch_state(src: Dict, result: Dict, new_count: int = 0) -> None:
+    status = result.get("status")
+    state: Dict[str, Any] = {"last_status": status}
+    state.update(scheduler.next_state(src, status, new_count))
+    # A 304 (or a failed request) may omit validators; keep the ones we already have
+    if status is not None and status != 304 and status < 400:
+        state["etag"] = result.get("etag")
+        state["last_modified"] = result.get("modified")
+    elif status == 304:
+        state["etag"] = result.get("etag") or src.get("etag")
+        state["last_modified"] = result.get("modified") or src.get("modified")
+    try:
+        db.update_feed_state(src["id"], **state)
+    except Exception as exc:
+        logger.warning("Failed to save fetch state for feed_id=%s: %s", src["id"], exc)
+
+def _ingest_entries(src: Dict, entries: List[Dict], persist: bool) -> Optional[List[Dict]]:
+    feed_id = src.get("id")
+    url = src.get("url")
+    articles: List[Dict] = []
+    for e in entries:
         try:
-            result = feeds.fetch_feed(url, max_entries=max_entries_per_feed)
+            articles.append({
+                "feed_id": feed_id,
+                "feed_url": url,
+                "guid": e.get("guid"),
+                "title": e.get("title") or "",
+                "link": e.get("link") or "",
+                "summary": e.get("summary") or "",
+                "published": e.get("published"),
+            })
         except Exception as exc:
-            logger.exception("Failed to fetch feed %s (feed_id=%s): %s", url, feed_id, exc)
-            continue
+            logger.exception("Failed processing entry from feed %s: %s", url, exc)
 
-        entries = result.get("entries", []) if isinstance(result, dict) else []
-        for e in entries:
-            try:
-                link = e.get("link") or ""
-                title = e.get("title") or ""
-                summary = e.get("summary") or ""
-                published = e.get("published")
-
-                if persist and feed_id is not None:
-                    try:
-                        if db.article_exists(feed_id, link):
-                            continue
-                    except Exception:
-                        logger.debug("article_exists check failed for feed_id=%s link=%s; will attempt insert", feed_id, link)
-
-                if persist:
-                    try:
-                        db.add_article(feed_id, title, link, summary, None, published)
-                        new_articles.append({
-                            "feed_id": feed_id,
-                            "feed_url": url,
-                            "guid": e.get("guid"),
-                            "title": title,
-                            "link": link,
-                            "summary": summary,
-                            "published": published,
-                        })
-                    except Exception as exc:
-                        logger.exception("Failed to insert article for feed %s: %s", url, exc)
-                        continue
-                else:
-                    new_articles.append({
-                        "feed_id": feed_id,
-                        "feed_url": url,
-                        "guid": e.get("guid"),
-                        "title": title,
-                        "link": link,
-                        "summary": summary,
-                        "published": published,
-                    })
+    if not persist or not articles:
+        return articles
+
+    try:
+        inserted = db.add_articles(feed_id, articles)
+    except Exception as exc:
+        logger.exception("Failed to insert articles for feed %s: %s", url, exc)
+        return None
+
+    ids = {r["link"]: r["id"] for r in inserted}
+    new_articles = []
+    for a in articles:
+        if a["link"] in ids:
+            a["id"] = ids.pop(a["link"])
+            new_articles.append(a)
+    return new_articles
+
+@contextmanager
+def _parse_pool(processes: Optional[int] = None):
+    n = processes if processes is not None else getattr(config, "PARSE_PROCESSES", 0)
+    if n and n >= 1 and getattr(config, "KEEP_RAW_ENTRIES", False):
+        logger.warning("KEEP_RAW_ENTRIES needs in-process parsing; ignoring PARSE_PROCESSES=%d", n)
+        n = 0
+    if not n or n < 1:
+        yield None
+        return
+    # Workers are started from fetch threads (and from the web app's job thread), and forking a
+    # process that holds other threads' locks (DB pool, logging) can deadlock the child; a fork
+    # server, or a fresh interpreter where there is none, starts them from a clean process
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    with ProcessPoolExecutor(max_workers=n, mp_context=multiprocessing.get_context(method)) as pool:
+        yield pool
+
+def _process_result(src: Dict, result: Dict, persist: bool) -> List[Dict]:
+    feed_id = src.get("id")
+    url = src.get("url")
+    if result.get("status") is None and result.get("bozo_exception") is not None:
+        logger.error("Failed to fetch feed %s (feed_id=%s): %s", url, feed_id, result.get("bozo_exception"))
+        if persist and feed_id is not None:
+            _save_fetch_state(src, result)
+        return []
+
+    entries = result.get("entries", []) if isinstance(result, dict) else []
+    ingested = _ingest_entries(src, entries, persist)
+    if ingested is None:
+        return []
 
+    # Only remember the validators once this feed's entries have been stored
+    if persist and feed_id is not None:
+        _save_fetch_state(src, result, len(ingested))
+    return ingested
+
+def enrich_articles(articles: List[Dict], executor: Optional[Executor] = None) -> None:
+    # Derive the composer's per-article fields once, at ingest time (in the parse pool if there
+    # is one), into the prepared-item caches that this run's compose and any later one read.
+    if not articles:
+        return
+    chars = getattr(config, "SUMMARY_CHARS", composer.DEFAULT_SUMMARY_CHARS)
+    sources = [{"feed_url": a.get("feed_url"), "summary": a.get("summary")} for a in articles]
+    try:
+        if executor is not None:
+            derived = list(executor.map(composer.derive_fields, sources, [chars] * len(sources), chunksize=32))
+        else:
+            derived = [composer.derive_fields(src, chars) for src in sources]
+    except Exception as exc:
+        logger.exception("Failed to enrich articles: %s", exc)
+        return
+
+    composer.remember_prepared(sources, derived, chars)
+
+def run_once(
+    feed_urls: Optional[List[str]] = None,
+    max_entries_per_feed: Optional[int] = None,
+    persist: bool = True,
+    max_workers: Optional[int] = None,
+    per_host: Optional[int] = None,
+    parse_processes: Optional[int] = None,
+    only_due: Optional[bool] = None,
+    enrich: Optional[bool] = None,
+) -> List[Dict]:
+    new_articles: List[Dict] = []
+    if enrich is None:
+        enrich = getattr(config, "ENRICH_AT_INGEST", True)
+
+    if only_due is None:
+        only_due = persist and getattr(config, "ADAPTIVE_POLLING", True)
+    sources = _load_sources(feed_urls, only_due=only_due)
+    if not sources:
+        return []
+
+    sources = [s for s in sources if s.get("url")]
+    if config.DEBUG:
+        for src in sources:
+            logger.info("Fetching feed %s (feed_id=%s, persist=%s)", src["url"], src.get("id"), persist)
+
+    # Conditional GETs and known-entry filters only make sense when we remember what we've already stored
+    if persist:
+        _attach_known(sources)
+    stop_after_known = getattr(config, "STOP_AFTER_KNOWN", None)
+    jobs = [
+        {
+            "url": src["url"],
+            "etag": src.get("etag"),
+            "modified": src.get("modified"),
+            "known": src.get("known"),
+            "stop_after_known": stop_after_known,
+        } if persist else {"url": src["url"]}
+        for src in sources
+    ]
+
+    started = time.perf_counter()
+    with _parse_pool(parse_processes) as parse_executor:
+        results = feeds.fetch_feeds(
+            jobs,
+            max_workers=max_workers or getattr(config, "FETCH_WORKERS", 16),
+            per_host=per_host or getattr(config, "FETCH_PER_HOST", 2),
+            max_entries=max_entries_per_feed,
+            parse_executor=parse_executor,
+            keep_raw=getattr(config, "KEEP_RAW_ENTRIES", False),
+        )
+        _record_timings(sources, results, time.perf_counter() - started)
+
+        for src, result in zip(sources, results):
+            new_articles.extend(_process_result(src, result, persist))
+
+        if enrich:
+            enrich_articles(new_articles, parse_executor)
+
+    return new_articles
+
+async def run_once_async(
+    feed_urls: Optional[List[str]] = None,
+    max_entries_per_feed: Optional[int] = None,
+    persist: bool = True,
+    max_workers: Optional[int] = None,
+    per_host: Optional[int] = None,
+    parse_processes: Optional[int] = None,
+    only_due: Optional[bool] = None,
+    enrich: Optional[bool] = None,
+) -> List[Dict]:
+    # Same contract as run_once(), but each feed is ingested as soon as its own
+    # download finishes, overlapping DB work with the network waits on the others
+    loop = asyncio.get_running_loop()
+    if enrich is None:
+        enrich = getattr(config, "ENRICH_AT_INGEST", True)
+    workers = max_workers or getattr(config, "FETCH_WORKERS", 16)
+    host_limit = per_host or getattr(config, "FETCH_PER_HOST", 2)
+
+    # The parse pool is set up before any of this run's threads exist
+    with _parse_pool(parse_processes) as parse_executor, \
+            ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fetch") as net_pool, \
+            ThreadPoolExecutor(max_workers=getattr(config, "DB_POOL_MAX", 10), thread_name_prefix="ingest") as db_pool:
+        if only_due is None:
+            only_due = persist and getattr(config, "ADAPTIVE_POLLING", True)
+        sources = await loop.run_in_executor(db_pool, _load_sources, feed_urls, only_due)
+        if not sources:
+            return []
+        sources = [s for s in sources if s.get("url")]
+        if persist:
+            await loop.run_in_executor(db_pool, _attach_known, sources)
+        stop_after_known = getattr(config, "STOP_AFTER_KNOWN", None)
+
+        slots = asyncio.Semaphore(workers)
+        host_slots: Dict[str, asyncio.Semaphore] = {}
+        results: List[Dict] = [{} for _ in sources]
+
+        async def _one(i: int, src: Dict) -> List[Dict]:
+            url = src["url"]
+            host_slot = host_slots.setdefault(feeds._host_of(url), asyncio.Semaphore(max(1, host_limit)))
+            fetch = partial(
+                feeds.fetch_feed,
+                url,
+                etag=src.get("etag") if persist else None,
+                modified=src.get("modified") if persist else None,
+                max_entries=max_entries_per_feed,
+                parse_executor=parse_executor,
+                keep_raw=getattr(config, "KEEP_RAW_ENTRIES", False),
+                known=src.get("known") if persist else None,
+                stop_after_known=stop_after_known if persist else None,
+            )
+            started = time.perf_counter()
+            async with host_slot, slots:
+                try:
+                    result = await loop.run_in_executor(net_pool, fetch)
+                except Exception as exc:
+                    result = {"entries": [], "status": None, "etag": None, "modified": None, "bozo": True, "bozo_exception": exc}
+            result["elapsed"] = time.perf_counter() - started
+            results[i] = result
+            try:
+                batch = await loop.run_in_executor(db_pool, _process_result, src, result, persist)
+                if enrich:
+                    await loop.run_in_executor(db_pool, enrich_articles, batch, parse_executor)
+                return batch
             except Exception as exc:
-                logger.exception("Failed processing entry from feed %s: %s", url, exc)
-                continue
+                logger.exception("Failed processing feed %s: %s", url, exc)
+                return []
+
+        started = time.perf_counter()
+        per_feed = await asyncio.gather(*(_one(i, src) for i, src in enumerate(sources)))
+        _record_timings(sources, results, time.perf_counter() - started)
 
-    return new_articles
\ No newline at end of file
+    return [a for batch in per_feed for a in batch]
\ No newline at end of file
@@ -0,0 +1,148 @@
+## Rewrites feed summary HTML in a single pass: absolute URLs, thumbnail extraction and plain text
+
+from functools import lru_cache
+import html
+import re
+from typing import List, Optional, Tuple
+from urllib.parse import urljoin
+
+_ABSOLUTE_SRC = re.compile(r"^(data:|cid:|http:|https:|mailto:|javascript:)", re.I)
+_ABSOLUTE_HREF = re.compile(r"^(http:|https:|mailto:|javascript:|#)", re.I)
+_ABSOLUTE_THUMB = re.compile(r"^(http:|https:|data:|cid:)", re.I)
+
+# Applied to a single "<...>" slice that is already known to end at the first ">",
+# so none of these can scan past the current tag
+_TAG_NAME = re.compile(r"<(/?)([a-zA-Z][a-zA-Z0-9:-]*)")
+_URL_ATTR = re.compile(r"""(?<![\w-])(src|href)\s*=\s*(?:"([^"]*)"|'([^']*)')""", re.I)
+_RAW_TEXT_END = {
+    "script": re.compile(r"</script\s*>", re.I),
+    "style": re.compile(r"</style\s*>", re.I),
+}
+
+_SPACE_BEFORE_NEWLINE = re.compile(r"\s+\n")
+_MANY_NEWLINES = re.compile(r"\n{3,}")
+_MANY_SPACES = re.compile(r"[ \t]{2,}")
+
+@lru_cache(maxsize=4096)
+def _join(base_url: str, value: str) -> str:
+    try:
+        return urljoin(base_url, value)
+    except Exception:
+        return value
+
+def _absolute(name: str, value: str, base_url: Optional[str]) -> str:
+    if not base_url or not value:
+        return value
+    pattern = _ABSOLUTE_SRC if name == "src" else _ABSOLUTE_HREF
+    if pattern.match(value):
+        return value
+    return _join(base_url, value)
+
+def _thumbnail(src: str, base_url: Optional[str]) -> str:
+    if _ABSOLUTE_THUMB.match(src):
+        return src
+    return _join(base_url or "", src)
+
+def _tidy_text(text: str) -> str:
+    text = html.unescape(text)
+    text = _SPACE_BEFORE_NEWLINE.sub("\n", text)
+    text = _MANY_NEWLINES.sub("\n\n", text)
+    text = _MANY_SPACES.sub(" ", text)
+    return text.strip()
+
+def process_summary(html_fragment: Optional[str], base_url: Optional[str]) -> Tuple[str, Optional[str], str]:
+    # Returns (html with absolute URLs and the first <img> removed, thumbnail URL, plain text).
+    # Every character is visited a bounded number of times, so cost is linear in the input.
+    if not html_fragment:
+        return "", None, ""
+    s = html_fragment
+    n = len(s)
+    out: List[str] = []
+    text: List[str] = []
+    thumbnail: Optional[str] = None
+    first_img_removed = False
+    open_links: List[Optional[str]] = []
+    pos = 0
+
+    while pos < n:
+        lt = s.find("<", pos)
+        if lt == -1:
+            out.append(s[pos:])
+            text.append(s[pos:])
+            break
+        if lt > pos:
+            out.append(s[pos:lt])
+            text.append(s[pos:lt])
+
+        if s.startswith("<!--", lt):
+            end = s.find("-->", lt + 4)
+            end = n if end == -1 else end + 3
+            out.append(s[lt:end])
+            pos = end
+            continue
+
+        gt = s.find(">", lt + 1)
+        if gt == -1:
+            # A dangling "<" with no closing ">" is just text
+            out.append(s[lt:])
+            text.append(s[lt:])
+            break
+        tag = s[lt:gt + 1]
+        pos = gt + 1
+
+        m = _TAG_NAME.match(tag)
+        if not m:
+            # Declarations, processing instructions, "< b >" and the like: markup, not text
+            out.append(tag)
+            continue
+        name = m.group(2).lower()
+
+        if m.group(1):
+            out.append(tag)
+            if name == "a" and open_links:
+                href = open_links.pop()
+                if href:
+                    text.append(f" ({href})")
+            continue
+
+        href = None
+        src = None
+        if "=" in tag and (base_url or name == "img" or name == "a"):
+            parts: List[str] = []
+            last = 0
+            for am in _URL_ATTR.finditer(tag):
+                attr = am.group(1).lower()
+                value = am.group(2) if am.group(2) is not None else am.group(3)
+                absolute = _absolute(attr, value, base_url)
+                if attr == "src" and src is None:
+                    src = absolute
+                elif attr == "href" and href is None:
+                    href = absolute
+                parts.append(tag[last:am.start()])
+                parts.append(f'{attr}="{absolute}"' if absolute != value else am.group(0))
+                last = am.end()
+            if parts:
+                parts.append(tag[last:])
+                tag = "".join(parts)
+
+        if name == "img":
+            if not first_img_removed:
+                # The first image becomes the thumbnail and is dropped from the body
+                first_img_removed = True
+                if src:
+                    thumbnail = _thumbnail(src, base_url)
+                continue
+            if thumbnail is None and src:
+                thumbnail = _thumbnail(src, base_url)
+        out.append(tag)
+
+        if name in _RAW_TEXT_END and not tag.endswith("/>"):
+            # Script/style bodies go to the HTML untouched and never reach the text
+            end = _RAW_TEXT_END[name].search(s, pos)
+            stop = n if end is None else end.end()
+            out.append(s[pos:stop])
+            pos = stop
+        elif name == "a" and not tag.endswith("/>"):
+            open_links.append(href)
+
+    return "".join(out), thumbnail, _tidy_text("".join(text))
@@ -0,0 +1,58 @@
+## Decides when each feed is next due to be polled, based on how often it actually changes
+
+from datetime import datetime, timedelta, UTC
+from typing import Dict, Optional, Any
+import config
+
+# Schedule columns hold naive UTC timestamps written only by this module
+SCHEDULE_FIELDS = ("next_due_at", "last_changed_at", "avg_interval_secs", "unchanged_streak", "error_streak")
+
+# Weight given to the newest observed interval when updating the average
+INTERVAL_SMOOTHING = 0.3
+
+def utc_now() -> datetime:
+    return datetime.now(UTC).replace(tzinfo=None)
+
+def _bounds():
+    min_secs = getattr(config, "POLL_MIN_INTERVAL", 300)
+    max_secs = max(min_secs, getattr(config, "POLL_MAX_INTERVAL", 43200))
+    error_max = max(min_secs, getattr(config, "POLL_ERROR_MAX_INTERVAL", 86400))
+    return min_secs, max_secs, error_max
+
+def is_due(feed: Dict[str, Any], now: Optional[datetime] = None) -> bool:
+    due = feed.get("next_due_at")
+    return due is None or due <= (now or utc_now())
+
+def next_state(feed: Dict[str, Any], status: Optional[int], new_count: int, now: Optional[datetime] = None) -> Dict[str, Any]:
+    now = now or utc_now()
+    min_secs, max_secs, error_max = _bounds()
+    avg = feed.get("avg_interval_secs")
+    unchanged = feed.get("unchanged_streak") or 0
+    errors = feed.get("error_streak") or 0
+    state: Dict[str, Any] = {}
+    ceiling = max_secs
+
+    if status is None or status >= 400:
+        # Dead or erroring feed: back off exponentially, independent of its usual cadence
+        errors += 1
+        delay = min_secs * 2 ** min(errors, 16)
+        ceiling = error_max
+        state["error_streak"] = errors
+    elif new_count > 0:
+        last_changed = feed.get("last_changed_at")
+        if last_changed is not None:
+            observed = max((now - last_changed).total_seconds(), min_secs)
+            avg = observed if avg is None else (1 - INTERVAL_SMOOTHING) * avg + INTERVAL_SMOOTHING * observed
+        state.update(last_changed_at=now, avg_interval_secs=avg, unchanged_streak=0, error_streak=0)
+        # Poll at twice the observed update rate so a new post waits at most ~half an interval
+        delay = avg / 2 if avg else min_secs
+    else:
+        # 304 or nothing new: stretch the interval, but never past the feed's usual cadence
+        unchanged += 1
+        cap = min(max(avg or max_secs, min_secs), max_secs)
+        delay = min(min_secs * 2 ** min(unchanged, 16), cap)
+        state.update(unchanged_streak=unchanged, error_streak=0)
+
+    delay = min(max(delay, min_secs), ceiling)
+    state["next_due_at"] = now + timedelta(seconds=delay)
+    return state
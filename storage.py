@@ -1,42 +1,266 @@
 ## Handles caching of html digests
 
 from pathlib import Path
+import gzip
+import hashlib
 import json
+import logging
+import shutil
+import tempfile
 from datetime import datetime, UTC
-from typing import List, Dict
+import threading
+from typing import BinaryIO, Callable, List, Dict, Iterable, Iterator, Optional, Tuple
+import config
+import db
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard as zstd
+except ImportError:
+    zstd = None
+
+logger = logging.getLogger(__name__)
 
 BASE = Path.cwd()
 DIGESTS_DIR = BASE / "digests"
+# Only read once, to migrate pre-catalogue installs into the digests table
 DIGEST_INDEX = DIGESTS_DIR / "index.json"
 
+# Content-Encoding -> suffix of the pre-compressed copy written next to each digest
+COMPRESSED_SUFFIXES = {"br": ".br", "gzip": ".gz"}
+
+# Compressed digests are stored once per distinct render, named by the SHA-256 of the HTML
+OBJECTS_DIR = DIGESTS_DIR / "objects"
+ARCHIVE_SUFFIXES = {"gzip": ".html.gz", "zstd": ".html.zst"}
+
 DIGESTS_DIR.mkdir(exist_ok=True)
 
-def load_digest_index() -> List[Dict]:
+_write_listeners: List[Callable[[Optional[Dict]], None]] = []
+_catalogue_lock = threading.Lock()
+_catalogue_ready = False
+
+def add_write_listener(fn: Callable[[Optional[Dict]], None]) -> None:
+    # Called after every catalogue write with the entry that changed: the new entry when a
+    # digest was added or rewritten, {"filename": ..., "removed": True} when one was removed.
+    # Listeners run on the writer's path (e.g. a send), so they must be cheap.
+    if fn not in _write_listeners:
+        _write_listeners.append(fn)
+
+def _notify_write(entry: Optional[Dict] = None) -> None:
+    for fn in list(_write_listeners):
+        try:
+            fn(entry)
+        except Exception:
+            logger.exception("Digest write listener failed")
+
+def _ensure_catalogue() -> None:
+    # Creates the digests table and imports a legacy index.json once per process
+    global _catalogue_ready
+    if _catalogue_ready:
+        return
+    with _catalogue_lock:
+        if _catalogue_ready:
+            return
+        db.ensure_digests_table()
+        _migrate_index_json()
+        _catalogue_ready = True
+
+def _migrate_index_json() -> None:
     if not DIGEST_INDEX.exists():
-        DIGEST_INDEX.write_text("[]", encoding="utf-8")
-        return []
-    return json.loads(DIGEST_INDEX.read_text(encoding="utf-8"))
-
-def save_digest_index(index: List[Dict]) -> None:
-    DIGEST_INDEX.write_text(json.dumps(index, ensure_ascii=False, indent=2), encoding="utf-8")
-
-def add_digest_entry(subject: str, filename: str, item_count: int) -> Dict:
-    index = load_digest_index()
-    entry = {
-        "subject": subject,
-        "filename": filename,
-        "item_count": item_count,
-        "timestamp": datetime.now(UTC).strftime("%Y-%m-%d %H:%M UTC"),
-    }
-    index.insert(0, entry)
-    index = index[:50]
-    save_digest_index(index)
+        return
+    try:
+        index = json.loads(DIGEST_INDEX.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        logger.exception("Could not read %s for migration; leaving it in place", DIGEST_INDEX.name)
+        return
+    if not isinstance(index, list):
+        logger.error("%s is not a list of digests; leaving it in place", DIGEST_INDEX.name)
+        return
+    rows = []
+    skipped = 0
+    for e in reversed(index):
+        # One bad entry must not stop the migration, which runs on the archive's first access
+        filename = e.get("filename") if isinstance(e, dict) else None
+        path = (DIGESTS_DIR / filename).resolve() if isinstance(filename, str) and filename else None
+        if path is None or DIGESTS_DIR not in path.parents or not path.is_file():
+            logger.warning("Skipping %s entry with a missing or unknown digest file: %r", DIGEST_INDEX.name, e)
+            skipped += 1
+            continue
+        try:
+            created = datetime.strptime(e["timestamp"], "%Y-%m-%d %H:%M UTC").replace(tzinfo=UTC)
+        except (KeyError, TypeError, ValueError):
+            created = datetime.now(UTC)
+        rows.append((e.get("subject") or "", filename, e.get("item_count") or 0, created))
+    imported = db.import_digests(rows)
+    try:
+        DIGEST_INDEX.replace(DIGEST_INDEX.with_name(DIGEST_INDEX.name + ".migrated"))
+    except OSError:
+        # Another process finished the same migration first
+        pass
+    logger.info("Imported %d digests from %s into the digests table (%d skipped)", imported, DIGEST_INDEX.name, skipped)
+
+def load_digest_index(limit: int = 50) -> List[Dict]:
+    # The most recent digests, newest first
+    _ensure_catalogue()
+    return db.list_digests(limit)
+
+def latest_digest() -> Optional[Dict]:
+    _ensure_catalogue()
+    return db.get_latest_digest()
+
+def list_digests(limit: int = 50, before: Optional[int] = None) -> Tuple[List[Dict], Optional[int]]:
+    # Returns one page of digests older than the `before` id, and the cursor for the next page
+    _ensure_catalogue()
+    rows = db.list_digests(limit + 1, before)
+    next_cursor = rows[limit - 1]["id"] if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+def get_digest_entry(filename: str) -> Optional[Dict]:
+    _ensure_catalogue()
+    return db.get_digest(filename)
+
+def add_digest_entry(subject: str, filename: str, item_count: int, content_hash: Optional[str] = None, encoding: Optional[str] = None) -> Dict:
+    _ensure_catalogue()
+    entry = db.add_digest(subject, filename, item_count, content_hash, encoding)
+    _notify_write(entry)
     return entry
 
+def remove_digest_entry(filename: str) -> None:
+    _ensure_catalogue()
+    db.delete_digest(filename)
+    _notify_write({"filename": filename, "removed": True})
+
+def _archive_encoding() -> Optional[str]:
+    encoding = (getattr(config, "DIGEST_ARCHIVE", "gzip") or "none").lower()
+    if encoding in ("", "none", "off", "false"):
+        return None
+    if encoding == "zstd" and zstd is None:
+        logger.warning("DIGEST_ARCHIVE=zstd but the zstandard package is not installed; using gzip")
+        return "gzip"
+    return encoding if encoding in ARCHIVE_SUFFIXES else "gzip"
+
+def _object_path(content_hash: str, encoding: str) -> Path:
+    return OBJECTS_DIR / content_hash[:2] / (content_hash + ARCHIVE_SUFFIXES[encoding])
+
+def _compressor(encoding: str, raw: BinaryIO) -> BinaryIO:
+    if encoding == "zstd":
+        return zstd.ZstdCompressor(level=19).stream_writer(raw, closefd=False)
+    # No name or mtime in the header, so identical renders compress to identical bytes
+    return gzip.GzipFile(filename="", fileobj=raw, mode="wb", compresslevel=9, mtime=0)
+
+def _write_object(chunks: Iterable[str], encoding: str) -> str:
+    # Hashes and compresses in one pass; identical renders end up as one shared object
+    OBJECTS_DIR.mkdir(exist_ok=True)
+    digest = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(dir=OBJECTS_DIR, suffix=".part", delete=False) as raw:
+        partial = Path(raw.name)
+        try:
+            out = _compressor(encoding, raw)
+            for chunk in chunks:
+                data = chunk.encode("utf-8")
+                digest.update(data)
+                out.write(data)
+            out.close()
+        except BaseException:
+            raw.close()
+            partial.unlink(missing_ok=True)
+            raise
+    content_hash = digest.hexdigest()
+    final = _object_path(content_hash, encoding)
+    if final.exists():
+        partial.unlink()
+    else:
+        final.parent.mkdir(exist_ok=True)
+        partial.replace(final)
+    return content_hash
+
 def write_digest_html(subject: str, html_body: str, item_count: int) -> str:
+    return write_digest_html_stream(subject, (html_body,), item_count)
+
+def write_digest_html_stream(subject: str, chunks: Iterable[str], item_count: int) -> str:
     stamp = datetime.now(UTC).strftime("%Y%m%dT%H%M%SZ")
     filename = f"digest-{stamp}.html"
+    encoding = _archive_encoding()
+    if encoding:
+        content_hash = _write_object(chunks, encoding)
+        add_digest_entry(subject, filename, item_count, content_hash, encoding)
+        return filename
+
     outpath = DIGESTS_DIR / filename
-    outpath.write_text(html_body, encoding="utf-8")
+    # Written under a temporary name so a failed render never leaves a half digest behind
+    partial = outpath.with_name(filename + ".part")
+    try:
+        with partial.open("w", encoding="utf-8") as f:
+            for chunk in chunks:
+                f.write(chunk)
+        partial.replace(outpath)
+    except BaseException:
+        partial.unlink(missing_ok=True)
+        raise
+    if getattr(config, "DIGEST_PRECOMPRESS", True):
+        _write_compressed(outpath)
     add_digest_entry(subject, filename, item_count)
-    return filename
\ No newline at end of file
+    return filename
+
+def digest_location(filename: str) -> Optional[Tuple[Path, Optional[str]]]:
+    # Where a digest's bytes live and how they are encoded: a plain file in digests/
+    # (older or uncompressed installs), or a compressed object named in the catalogue
+    plain = (DIGESTS_DIR / filename).resolve()
+    if DIGESTS_DIR not in plain.parents:
+        return None
+    if plain.is_file():
+        return plain, None
+    _ensure_catalogue()
+    entry = db.get_digest(filename)
+    if not entry or not entry.get("content_hash") or entry.get("encoding") not in ARCHIVE_SUFFIXES:
+        return None
+    path = _object_path(entry["content_hash"], entry["encoding"])
+    return (path, entry["encoding"]) if path.is_file() else None
+
+def iter_digest_bytes(path: Path, encoding: Optional[str], chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+    # Decoded HTML bytes, a chunk at a time, for clients that cannot take the stored encoding
+    with path.open("rb") as raw:
+        if encoding == "zstd":
+            src = zstd.ZstdDecompressor().stream_reader(raw)
+        elif encoding == "gzip":
+            src = gzip.GzipFile(fileobj=raw, mode="rb")
+        else:
+            src = raw
+        while True:
+            chunk = src.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+def _write_compressed(path: Path) -> None:
+    # Best effort: the web app falls back to the plain file when a variant is missing
+    try:
+        with path.open("rb") as src, gzip.open(path.with_name(path.name + ".gz"), "wb", compresslevel=9) as dst:
+            shutil.copyfileobj(src, dst)
+        if brotli is not None:
+            path.with_name(path.name + ".br").write_bytes(brotli.compress(path.read_bytes()))
+    except Exception:
+        logger.exception("Failed to write compressed copies of %s", path.name)
+
+def compressed_variant(filename: str, encoding: str) -> Optional[Path]:
+    suffix = COMPRESSED_SUFFIXES.get(encoding)
+    if suffix is None:
+        return None
+    path = DIGESTS_DIR / (filename + suffix)
+    try:
+        # A copy older than the digest itself is stale
+        if path.stat().st_mtime_ns >= (DIGESTS_DIR / filename).stat().st_mtime_ns:
+            return path
+    except OSError:
+        pass
+    return None
+
+def read_digest_html(filename: str) -> str:
+    location = digest_location(filename)
+    if location is None:
+        raise FileNotFoundError(filename)
+    return b"".join(iter_digest_bytes(*location)).decode("utf-8")
\ No newline at end of file
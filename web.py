@@ -1,16 +1,22 @@
 import os
+import gzip
+import hashlib
 import logging
+import mimetypes
+import tempfile
+import threading
+from dataclasses import dataclass
+from datetime import datetime, UTC
 from pathlib import Path
-from typing import List
-from flask import Flask, render_template, request, redirect, url_for, flash, send_file, abort, session
-from functools import wraps
+from typing import Callable, Dict, List, Optional, Tuple
+from flask import Flask, Response, render_template, request, redirect, url_for, flash, send_file, abort, session, jsonify
+from functools import lru_cache, wraps
 import secrets
 
 import config
 import db
-import rss_manager
-import composer
-import mailer
+import jobs
+import main as pipeline
 
 import recipients
 import storage
@@ -49,33 +55,225 @@ def save_recipients_list(email_list: List[str]) -> None:
         logger.exception("Failed to save recipients to DB: %s", e)
         raise e
 
+# Archive pages are cached in memory, keyed by the latest digest id; storage write
+# notifications drop the cache at once when this process writes
+
+@dataclass
+class _CachedPage:
+    stamp: Tuple
+    etag: str
+    last_modified: datetime
+    variants: Dict[Optional[str], bytes]
+
+# Archive pages are cached per cursor; past this many entries the cache starts over
+PAGE_CACHE_SIZE = 256
+ARCHIVE_PAGE_SIZE = 50
+
+_cache_lock = threading.Lock()
+_cache_generation = 0
+_page_cache: Dict[str, _CachedPage] = {}
+
+# Pages that wrap a whole digest are rendered once per digest into here and then served
+# straight from disk, so a request costs the same however large the digest is
+PAGES_DIR = storage.DIGESTS_DIR / "pages"
+
+def _invalidate_cache() -> None:
+    global _cache_generation
+    with _cache_lock:
+        _cache_generation += 1
+        _page_cache.clear()
+
+def _on_digest_written(entry: Optional[Dict]) -> None:
+    _invalidate_cache()
+    if entry is not None:
+        # A rewritten or removed digest's pages are stale; the next request renders afresh
+        _remove_pages(entry["filename"])
+
+storage.add_write_listener(_on_digest_written)
+
+@lru_cache(maxsize=None)
+def _template_version(template: str) -> str:
+    # Fixed per process, like Jinja's own template cache, so a stored page always matches
+    # the templates this process renders with
+    digest = hashlib.sha256()
+    for name in (template, "base.html"):
+        digest.update(app.jinja_loader.get_source(app.jinja_env, name)[0].encode("utf-8"))
+    version = digest.hexdigest()[:12]
+    _prune_pages(Path(template).stem, version)
+    return version
+
+def _page_path(template: str, filename: str) -> Path:
+    return PAGES_DIR / f"{Path(template).stem}-{_template_version(template)}-{filename}.gz"
+
+def _remove_pages(filename: str) -> None:
+    # Page names are "{stem}-{version}-{filename}.gz"; neither stem nor version has a dash
+    for path in PAGES_DIR.glob("*.gz"):
+        if path.name.split("-", 2)[-1] == f"{filename}.gz":
+            path.unlink(missing_ok=True)
+
+def _prune_pages(stem: str, version: str) -> None:
+    # Pages rendered with an older version of the template will never be served again
+    for path in PAGES_DIR.glob(f"{stem}-*.gz"):
+        if not path.name.startswith(f"{stem}-{version}-"):
+            path.unlink(missing_ok=True)
+
+def _prerendered_page(template: str, entry: Dict, location: Tuple[Path, Optional[str]]) -> Optional[Path]:
+    # Renders `template` around the digest on first request and keeps it gzipped in PAGES_DIR.
+    # Re-rendered only if the digest is newer than the stored page; None if the digest has gone.
+    path = _page_path(template, entry["filename"])
+    source = _file_stamp(location[0])
+    if source is None:
+        return None
+    stamp = _file_stamp(path)
+    if stamp is not None and stamp[0] >= source[0]:
+        return path
+
+    try:
+        digest_html = b"".join(storage.iter_digest_bytes(*location)).decode("utf-8")
+    except FileNotFoundError:
+        return None
+    body = render_template(template, digest_html=digest_html, subject=entry["subject"],
+                           generated_at=entry["timestamp"], filename=entry["filename"]).encode("utf-8")
+    PAGES_DIR.mkdir(exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=PAGES_DIR, suffix=".part", delete=False) as tmp:
+        tmp.write(gzip.compress(body, 9, mtime=0))
+    Path(tmp.name).replace(path)
+    return path
+
+def _send_page(path: Path) -> Response:
+    # Pages are only stored gzipped; the rare client that cannot take gzip gets them decoded
+    if _pick_encoding(["gzip"]):
+        # send_file gives us ETag/Last-Modified, 304s, Range requests and the server's sendfile path
+        resp = send_file(path, mimetype="text/html", conditional=True, max_age=None)
+        resp.headers["Content-Encoding"] = "gzip"
+    else:
+        st = path.stat()
+        resp = Response(storage.iter_digest_bytes(path, "gzip"), mimetype="text/html")
+        resp.set_etag(f"{st.st_mtime_ns:x}-{st.st_size:x}")
+        resp.last_modified = datetime.fromtimestamp(st.st_mtime, UTC)
+        resp = resp.make_conditional(request)
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["Vary"] = "Accept-Encoding"
+    return resp
+
+def _file_stamp(path: Path) -> Optional[Tuple[int, int]]:
+    try:
+        st = path.stat()
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+def _build_page(html: str, stamp: Tuple, last_modified: datetime) -> _CachedPage:
+    body = html.encode("utf-8")
+    variants: Dict[Optional[str], bytes] = {None: body, "gzip": gzip.compress(body, 6)}
+    if storage.brotli is not None:
+        variants["br"] = storage.brotli.compress(body)
+    return _CachedPage(
+        stamp=stamp,
+        etag=hashlib.sha256(body).hexdigest()[:32],
+        last_modified=last_modified,
+        variants=variants,
+    )
+
+def _pick_encoding(available, preference=("br", "gzip")) -> Optional[str]:
+    for encoding in preference:
+        if encoding in available and request.accept_encodings[encoding]:
+            return encoding
+    return None
+
+def _respond(page: _CachedPage) -> Response:
+    encoding = _pick_encoding(page.variants)
+    resp = Response(page.variants[encoding], mimetype="text/html")
+    # Each encoding is a different representation, so it needs its own strong validator
+    resp.set_etag(f"{page.etag}-{encoding}" if encoding else page.etag)
+    resp.last_modified = page.last_modified
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["Vary"] = "Accept-Encoding"
+    if encoding:
+        resp.headers["Content-Encoding"] = encoding
+    return resp.make_conditional(request)
+
+def _cached_page(key: str, stamp: Tuple, last_modified: datetime, render: Callable[[], str]):
+    if "_flashes" in session:
+        # Flashed messages are per visitor, so this render must not be shared
+        return render()
+    with _cache_lock:
+        page = _page_cache.get(key)
+        generation = _cache_generation
+    if page is None or page.stamp != stamp:
+        page = _build_page(render(), stamp, last_modified)
+        with _cache_lock:
+            if generation == _cache_generation:
+                if len(_page_cache) >= PAGE_CACHE_SIZE:
+                    _page_cache.clear()
+                _page_cache[key] = page
+    return _respond(page)
+
 @app.route("/")
 def public_latest():
-    index = storage.load_digest_index()
-    if not index:
+    latest = storage.latest_digest()
+    if latest is None:
         return render_template("public_empty.html", title="No digests yet")
-    latest = index[0]
-    html_path = (storage.DIGESTS_DIR / latest["filename"])
-    if not html_path.exists():
-        idx = [e for e in index if (storage.DIGESTS_DIR / e["filename"]).exists()]
-        storage.save_digest_index(idx)
+    location = storage.digest_location(latest["filename"])
+    if location is None:
+        storage.remove_digest_entry(latest["filename"])
         return redirect(url_for("public_archive"))
-    digest_html = html_path.read_text(encoding="utf-8")
-    return render_template("public.html", digest_html=digest_html, subject=latest["subject"], generated_at=latest["timestamp"])
+
+    if "_flashes" in session:
+        # Flashed messages are per visitor, so this render must not be shared
+        digest_html = b"".join(storage.iter_digest_bytes(*location)).decode("utf-8")
+        return render_template("public.html", digest_html=digest_html, subject=latest["subject"], generated_at=latest["timestamp"])
+    page = _prerendered_page("public.html", latest, location)
+    if page is None:
+        abort(404)
+    return _send_page(page)
 
 @app.route("/archive")
 def public_archive():
-    index = storage.load_digest_index()
-    return render_template("archive.html", digests=index)
+    before = request.args.get("before", type=int)
+    latest = storage.latest_digest()
+    if latest is None:
+        return render_template("archive.html", digests=[], next_cursor=None)
+
+    def render() -> str:
+        digests, next_cursor = storage.list_digests(ARCHIVE_PAGE_SIZE, before)
+        return render_template("archive.html", digests=digests, next_cursor=next_cursor)
+
+    return _cached_page(f"archive:{before}", (latest["id"],), latest["created_at"], render)
 
 @app.route("/digest/<path:filename>")
 def serve_digest(filename):
-    safe = (storage.DIGESTS_DIR / filename).resolve()
-    if storage.DIGESTS_DIR not in safe.parents and safe != storage.DIGESTS_DIR:
-        abort(404)
-    if not safe.exists():
+    location = storage.digest_location(filename)
+    if location is None:
         abort(404)
-    return send_file(safe)
+    path, stored = location
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    if stored is not None:
+        # Archived digests: send the stored bytes as they are, or decode them on the fly
+        # for the rare client that cannot take the encoding. Objects never change once written.
+        etag = path.name.split(".", 1)[0]
+        if _pick_encoding([stored], (stored,)):
+            resp = send_file(path, mimetype=mimetype, etag=f"{etag}-{stored}")
+            resp.headers["Content-Encoding"] = stored
+        else:
+            resp = Response(storage.iter_digest_bytes(path, stored), mimetype=mimetype)
+            resp.set_etag(etag)
+            resp.last_modified = datetime.fromtimestamp(path.stat().st_mtime, UTC)
+            resp = resp.make_conditional(request)
+        resp.headers["Vary"] = "Accept-Encoding"
+        return resp
+
+    rel = path.relative_to(storage.DIGESTS_DIR).as_posix()
+    variants = {e: p for e in storage.COMPRESSED_SUFFIXES if (p := storage.compressed_variant(rel, e))}
+    encoding = _pick_encoding(variants)
+    if encoding:
+        resp = send_file(variants[encoding], mimetype=mimetype)
+        resp.headers["Content-Encoding"] = encoding
+    else:
+        resp = send_file(path)
+    if variants:
+        resp.headers["Vary"] = "Accept-Encoding"
+    return resp
 
 @app.route("/admin/login", methods=["GET", "POST"])
 def admin_login():
@@ -123,7 +321,7 @@ def admin_index():
                 normalized.append({"url": str(r)})
     recips = load_recipients()
     digests = storage.load_digest_index()
-    return render_template("admin.html", feeds=normalized, recipients=recips, digests=digests)
+    return render_template("admin.html", feeds=normalized, recipients=recips, digests=digests, job=jobs.latest())
 
 @app.route("/admin/feeds/add", methods=["POST"])
 @admin_required
@@ -163,46 +361,51 @@ def admin_save_recipients():
         flash(f"Failed saving recipients: {e}", "error")
     return redirect(url_for("admin_index"))
 
+def _digest_run(progress: jobs.Progress) -> None:
+    # The same pipeline as the cron entry point, so both share the outbox and the run lock;
+    # unlike cron it does not wait for the lock, so the dashboard reports a clash straight away
+    code = pipeline.main(progress=progress, wait_for_lock=False)
+    if code:
+        raise RuntimeError(pipeline.EXIT_MESSAGES.get(code, f"Run failed (exit code {code})"))
+
 @app.route("/admin/run", methods=["POST"])
 @admin_required
 def admin_run_digest():
-    logger.info("Admin initiated run: fetch/persist/compose/send")
-    try:
-        items = rss_manager.run_once(max_entries_per_feed=config.MAX_ENTRIES_PER_FEED, persist=True)
-        logger.info("Fetched %d items", len(items))
-        if not items:
-            flash("No new items found. No digest created.", "info")
-            return redirect(url_for("admin_index"))
-        subject, html_body, text_body = composer.compose_digest(items, max_items=config.MAX_ITEMS)
-        filename = storage.write_digest_html(subject, html_body, len(items))
-        flash(f"Digest created and cached as {filename}", "success")
-        recips = load_recipients() or getattr(config, "EMAIL_TO", [])
-        if not recips:
-            flash("No recipients configured; digest created but not sent.", "warning")
-            return redirect(url_for("admin_index"))
-        try:
-            mailer.send_digest(recipients=recips, subject=subject, html_body=html_body, text_body=text_body,
-                               send_individually=config.SEND_INDIVIDUALLY)
-            flash(f"Digest sent to {len(recips)} recipients.", "success")
-        except Exception as e:
-            logger.exception("send_digest failed")
-            flash(f"Digest created but sending failed: {e}", "error")
-    except Exception as e:
-        logger.exception("admin_run_digest failed")
-        flash(f"Operation failed: {e}", "error")
+    job, started = jobs.start("digest run", _digest_run)
+    if started:
+        logger.info("Admin started digest run %s", job["id"])
+        flash("Digest run started", "success")
+    else:
+        flash("A digest run is already in progress", "info")
     return redirect(url_for("admin_index"))
 
+@app.route("/admin/jobs/<job_id>")
+@admin_required
+def admin_job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job)
 
 @app.route("/admin/digests/<path:filename>")
 @admin_required
 def admin_view_digest(filename):
-    safe = (storage.DIGESTS_DIR / filename).resolve()
-    if storage.DIGESTS_DIR not in safe.parents and safe != storage.DIGESTS_DIR:
+    location = storage.digest_location(filename)
+    if location is None:
         abort(404)
-    if not safe.exists():
+    if "_flashes" in session:
+        digest_html = b"".join(storage.iter_digest_bytes(*location)).decode("utf-8")
+        return render_template("admin_view_digest.html", digest_html=digest_html, filename=filename)
+    entry = storage.get_digest_entry(filename) or {"filename": filename, "subject": filename, "timestamp": ""}
+    page = _prerendered_page("admin_view_digest.html", entry, location)
+    if page is None:
         abort(404)
-    digest_html = safe.read_text(encoding="utf-8")
-    return render_template("admin_view_digest.html", digest_html=digest_html, filename=filename)
+    return _send_page(page)
+
+@app.route("/admin/pool")
+@admin_required
+def admin_pool_stats():
+    return jsonify(db.pool_stats())
 
 
 if __name__ == "__main__":